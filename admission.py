@@ -0,0 +1,250 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, g
+
+'''
+Admission control
+Rejects requests straight away when a client or the server is over
+capacity, rather than letting them queue in the worker until they time
+out. Applied to authenticated routes with the admit(route_class)
+decorator, after requires_auth:
+- each token (by its sub claim) has a token bucket of RATE_LIMIT_BURST
+  requests, refilled at RATE_LIMIT_RATE requests per second. Requests
+  with an empty bucket get a 429
+- each route class has a cap on the requests in flight at once, so
+  expensive reads can't take up every slot needed by cheap writes.
+  Requests over the cap get a 503
+Both responses carry a Retry-After header.
+
+Route classes are 'read' (single records), 'list' (full lists and change
+lists), 'export', 'stream' (event streams), 'write' and 'bulk'.
+'''
+
+# Default concurrency caps per route class, 0 for no cap
+ROUTE_CLASSES = {
+    'read': 0,
+    'list': 20,
+    'export': 4,
+    'stream': 100,
+    'write': 0,
+    'bulk': 4
+}
+ADMISSION_MAX_CLIENTS = int(os.environ.get('ADMISSION_MAX_CLIENTS', 10000))
+
+
+'''
+AdmissionError Exception
+Raised when a request is turned away, with the number of seconds the
+client should wait before retrying
+'''
+
+
+class AdmissionError(Exception):
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+'''
+Admission stores
+Keep the token buckets and the number of requests in flight. Every store
+provides take(key, rate, burst), which takes a token from a bucket and
+returns 0, or returns the seconds until one will be available;
+acquire(route_class, limit) and release(route_class), which count the
+requests in flight; clear() and stats().
+
+LocalAdmissionStore keeps them in memory, so each worker process applies
+the limits on its own. A store shared between workers (e.g. in Redis,
+taking tokens with an atomic script) can be added by subclassing
+AdmissionStore.
+'''
+
+
+class AdmissionStore:
+    name = 'store'
+
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+    def acquire(self, route_class, limit):
+        raise NotImplementedError
+
+    def release(self, route_class):
+        raise NotImplementedError
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class LocalAdmissionStore(AdmissionStore):
+    name = 'local'
+
+    def __init__(self, maxsize=ADMISSION_MAX_CLIENTS):
+        self.maxsize = maxsize
+        # key: (tokens, time of the last refill)
+        self.buckets = OrderedDict()
+        self.in_flight = {}
+        self.lock = Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            # Forgetting a client only gives it a full bucket again
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def acquire(self, route_class, limit):
+        with self.lock:
+            in_flight = self.in_flight.get(route_class, 0)
+            if limit and in_flight >= limit:
+                return False
+            self.in_flight[route_class] = in_flight + 1
+            return True
+
+    def release(self, route_class):
+        with self.lock:
+            self.in_flight[route_class] -= 1
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': self.name,
+                'clients': len(self.buckets),
+                'in_flight': dict(self.in_flight)
+            }
+
+
+'''
+NullAdmissionStore
+Used when ADMISSION_STORE is set to 'none', admitting every request.
+'''
+
+
+class NullAdmissionStore(AdmissionStore):
+    name = 'none'
+
+    def take(self, key, rate, burst):
+        return 0
+
+    def acquire(self, route_class, limit):
+        return True
+
+    def release(self, route_class):
+        pass
+
+
+'''
+get_admission_store()
+    chooses the store from ADMISSION_STORE: 'local' (default) or 'none'
+'''
+
+
+def get_admission_store():
+    store = os.environ.get('ADMISSION_STORE', 'local').lower()
+    if store == 'none':
+        return NullAdmissionStore()
+    return LocalAdmissionStore()
+
+
+admission_store = get_admission_store()
+
+rejected = {'rate_limited': 0, 'overloaded': 0}
+rejected_lock = Lock()
+
+
+def reject(reason, error, status_code, retry_after):
+    with rejected_lock:
+        rejected[reason] += 1
+    raise AdmissionError(error, status_code,
+                         max(1, math.ceil(retry_after)))
+
+
+def admission_stats():
+    with rejected_lock:
+        return dict(admission_store.stats(), rejected=dict(rejected))
+
+
+'''
+admit(route_class)
+    decorator applying the token bucket of the request's token and the
+    cap of the route class. Goes below requires_auth, receiving the
+    token payload
+'''
+
+
+def admit(route_class):
+    def admit_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            config = current_app.config
+            rate = config['RATE_LIMIT_RATE']
+            if rate > 0:
+                wait = admission_store.take(payload.get('sub', ''), rate,
+                                            config['RATE_LIMIT_BURST'])
+                if wait:
+                    reject('rate_limited', 'too many requests', 429, wait)
+
+            limit = config['CONCURRENCY_LIMITS'][route_class]
+            if not admission_store.acquire(route_class, limit):
+                reject('overloaded', 'service unavailable', 503,
+                       config['ADMISSION_RETRY_AFTER'])
+            # Released when the request ends, after any streamed body
+            g.admitted = getattr(g, 'admitted', []) + [route_class]
+            return f(payload, *args, **kwargs)
+
+        return wrapper
+    return admit_decorator
+
+
+def release_admitted(error=None):
+    for route_class in g.pop('admitted', []):
+        admission_store.release(route_class)
+
+
+'''
+init_admission(app)
+    reads the limits from the environment into the app config and
+    registers the release of admitted requests:
+    RATE_LIMIT_RATE (default 20 requests per second, 0 to disable),
+    RATE_LIMIT_BURST (default 40), CONCURRENCY_LIMIT_<ROUTE CLASS>
+    (defaults in ROUTE_CLASSES) and ADMISSION_RETRY_AFTER (default 1
+    second, for 503 responses)
+'''
+
+
+def init_admission(app):
+    app.config.setdefault('RATE_LIMIT_RATE', float(
+        os.environ.get('RATE_LIMIT_RATE', 20)))
+    app.config.setdefault('RATE_LIMIT_BURST', float(
+        os.environ.get('RATE_LIMIT_BURST', 40)))
+    app.config.setdefault('CONCURRENCY_LIMITS', {
+        route_class: int(os.environ.get(
+            'CONCURRENCY_LIMIT_' + route_class.upper(), limit))
+        for route_class, limit in ROUTE_CLASSES.items()
+    })
+    app.config.setdefault('ADMISSION_RETRY_AFTER', int(
+        os.environ.get('ADMISSION_RETRY_AFTER', 1)))
+    app.teardown_request(release_admitted)
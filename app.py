@@ -1,11 +1,552 @@
 import os
 import datetime
-from flask import Flask, json, request, abort, jsonify, redirect
+from functools import wraps
+from flask import Flask, json, request, abort, jsonify, redirect, \
+    Response, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
 
-from models import setup_db, Movie, Actor
-from auth import AuthError, requires_auth
+from models import db, setup_db, Movie, Actor, Casting, pool_status, \
+    replica_pool_status, bulk_insert, bulk_update, bulk_delete, \
+    fetch_instances, fetch_by_ids, fetch_changes, fetch_change_events, \
+    fetch_statistics, update_returning, delete_returning
+from auth import AuthError, requires_auth, check_permissions, token_cache
+from admission import AdmissionError, admit, admission_stats, \
+    init_admission
+from versions import version_store
+from cache import response_cache, record_cache
+from events import event_broker, event_transport, parse_event_id
+from metrics import init_metrics, request_metrics, timed
+from compression import init_compression
+from serialization import dumps, json_response
+
+'''
+full_list_requested()
+    POST and DELETE responses only include the affected record by default.
+    Clients can opt in to the previous response, which also includes the
+    full list of records, with ?response=full or an X-Response-Mode: full
+    header.
+'''
+
+
+def full_list_requested():
+    mode = request.args.get('response',
+                            request.headers.get('X-Response-Mode', 'minimal'))
+    return mode.lower() == 'full'
+
+
+'''
+conditional(*models)
+    decorator adding a strong ETag, based on the versions of the tables
+    the response is built from, to GET responses. Requests with a
+    matching If-None-Match header get a 304 response without querying
+    the database. If-None-Match uses the weak comparison, so the tag
+    still matches once compression has marked it weak.
+'''
+
+
+def table_etag(*models):
+    return '-'.join('{}-{}'.format(model.__tablename__,
+                                   version_store.get(model.__tablename__))
+                    for model in models)
+
+
+def conditional(*models):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = table_etag(*models)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+'''
+cached(*models)
+    decorator serving GET responses from the response cache. Entries are
+    keyed by the table versions and the full request path, so the
+    database and JSON encoder are only used on a miss.
+'''
+
+
+def cached(*models):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = '{}:{}'.format(table_etag(*models), request.full_path)
+            body = response_cache.get(key)
+            if body is not None:
+                return Response(body, mimetype='application/json')
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, response.get_data())
+            return response
+
+        return wrapper
+    return cached_decorator
+
+
+'''
+paginate(model, stmt, fetch)
+    keyset pagination on id, using the ?limit= and ?after= arguments.
+    Runs the select statement with fetch (fetch_instances or
+    model.fetch_rows) and returns the page of records and the cursor for
+    the next page (None on the last page). Without a limit every record
+    after the cursor is returned.
+'''
+
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+
+def paginate(model, stmt, fetch):
+    try:
+        limit = request.args.get('limit', None)
+        after = request.args.get('after', None)
+        limit = int(limit) if limit is not None else None
+        after = int(after) if after is not None else None
+    except ValueError:
+        abort(400)
+
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+
+    stmt = stmt.order_by(model.id)
+    if after is not None:
+        stmt = stmt.filter(model.id > after)
+    if limit is None:
+        return fetch(stmt), None
+
+    # Fetch one extra row to find out whether there is a next page
+    records = fetch(stmt.limit(limit + 1))
+    if len(records) > limit:
+        return records[:limit], records[limit - 1].id
+    return records, None
+
+
+'''
+expand_arg(option)
+    checks the ?expand= argument, which may only be the given option.
+    Expanded list responses load the related records with one extra
+    batched query per page, however many records are on the page.
+'''
+
+
+def expand_arg(option):
+    expand = request.args.get('expand', None)
+    if expand not in (None, option):
+        abort(400)
+    return expand is not None
+
+
+'''
+ids_arg()
+    parses the ?ids= argument, a comma separated list of up to
+    MAX_PAGE_SIZE ids, for looking up several records at once
+'''
+
+
+def ids_arg():
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',')]
+    except ValueError:
+        abort(400)
+    if len(ids) > MAX_PAGE_SIZE:
+        abort(400)
+    # Drop repeated ids, keeping the order given
+    return list(dict.fromkeys(ids))
+
+
+'''
+Search filters
+filter_movies(query)
+    ?title= (substring), ?title_prefix=, ?actor= (substring of the name
+    of a cast member), ?release_from= and ?release_to= (inclusive,
+    DD/MM/YYYY)
+filter_actors(query)
+    ?name= (substring), ?name_prefix=, ?age_min=, ?age_max= (inclusive)
+    and ?gender=
+Text matches are case-insensitive. Invalid values abort with 400.
+'''
+
+
+def like_pattern(value, prefix=False):
+    value = value.replace('\\', '\\\\')\
+        .replace('%', '\\%').replace('_', '\\_')
+    return value + '%' if prefix else '%' + value + '%'
+
+
+def date_arg(name):
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, "%d/%m/%Y").date()
+    except ValueError:
+        abort(400)
+
+
+def int_arg(name):
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def filter_movies(query):
+    title = request.args.get('title', None)
+    if title:
+        query = query.filter(
+            Movie.title.ilike(like_pattern(title), escape='\\'))
+    title_prefix = request.args.get('title_prefix', None)
+    if title_prefix:
+        query = query.filter(Movie.title.ilike(
+            like_pattern(title_prefix, prefix=True), escape='\\'))
+    actor = request.args.get('actor', None)
+    if actor:
+        query = query.filter(Movie.cast.any(Casting.actor.has(
+            Actor.name.ilike(like_pattern(actor), escape='\\'))))
+
+    release_from = date_arg('release_from')
+    if release_from is not None:
+        query = query.filter(Movie.release >= release_from)
+    release_to = date_arg('release_to')
+    if release_to is not None:
+        query = query.filter(Movie.release <= release_to)
+    return query
+
+
+def filter_actors(query):
+    name = request.args.get('name', None)
+    if name:
+        query = query.filter(
+            Actor.name.ilike(like_pattern(name), escape='\\'))
+    name_prefix = request.args.get('name_prefix', None)
+    if name_prefix:
+        query = query.filter(Actor.name.ilike(
+            like_pattern(name_prefix, prefix=True), escape='\\'))
+
+    age_min = int_arg('age_min')
+    if age_min is not None:
+        query = query.filter(Actor.age >= age_min)
+    age_max = int_arg('age_max')
+    if age_max is not None:
+        query = query.filter(Actor.age <= age_max)
+
+    gender = request.args.get('gender', None)
+    if gender:
+        if len(gender) != 1:
+            abort(400)
+        query = query.filter(Actor.gender == gender.upper())
+    return query
+
+
+'''
+export_records(model)
+    streams every record of the model as NDJSON (one object per line,
+    the default) or as a JSON array with ?format=json. Rows are read in
+    batches through a server-side cursor, so memory use stays flat
+    regardless of the size of the table.
+'''
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+
+def export_records(model):
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in ('ndjson', 'json'):
+        abort(400)
+
+    stmt = model.select_rows().order_by(model.id)\
+        .execution_options(stream_results=True)
+
+    # One chunk per batch, so each batch is a single write to the socket
+    def batches():
+        result = db.session.connection().execute(stmt)
+        for partition in result.partitions(EXPORT_BATCH_SIZE):
+            yield [dumps(row.format())
+                   for row in map(model.row_type._make, partition)]
+
+    def generate_ndjson():
+        for batch in batches():
+            yield b'\n'.join(batch) + b'\n'
+
+    def generate_json():
+        yield b'['
+        separator = b''
+        for batch in batches():
+            yield separator + b','.join(batch)
+            separator = b','
+        yield b']'
+
+    if export_format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()),
+                    mimetype='application/json')
+
+
+'''
+stream_events(model)
+    streams the model's change events (see events.py) as Server-Sent
+    Events, with the event's id and the change type as the event name. A
+    client reconnecting with a Last-Event-ID header (or ?since=, either
+    an event id or a version) is first sent the changes it missed, read
+    from the change log, then live events. While idle a comment is sent every
+    EVENT_KEEPALIVE seconds, so proxies keep the connection open. A
+    stream that falls too far behind is closed, and the client catches up
+    when it reconnects.
+'''
+
+EVENT_KEEPALIVE = float(os.environ.get('EVENT_KEEPALIVE', 15))
+
+
+def format_event(event):
+    return b'id: %s\nevent: %s\ndata: %s\n\n' % (
+        event['id'].encode(), event['type'].encode(), dumps(event))
+
+
+def stream_events(model):
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    cursor = None
+    if since is not None:
+        try:
+            cursor = parse_event_id(since)
+        except ValueError:
+            abort(400)
+
+    # Subscribe before reading the missed changes, so none are lost in
+    # between. Events already replayed are skipped
+    subscription = event_broker.subscribe(model.__tablename__)
+    replay, replayed = [], None
+    try:
+        if cursor is not None:
+            replay, replayed = fetch_change_events(model, cursor)
+    except Exception:
+        event_broker.unsubscribe(subscription)
+        raise
+    # Return the connection to the pool for the rest of the stream
+    db.session.remove()
+
+    def generate():
+        # Sent straight away, so the response starts before any event
+        yield b': connected\n\n'
+        for event in replay:
+            yield format_event(event)
+        while not subscription.overflowed:
+            event = subscription.get(EVENT_KEEPALIVE)
+            if event is None:
+                yield b': keepalive\n\n'
+            elif replayed is None or event['version'] > replayed:
+                yield format_event(event)
+
+    response = Response(stream_with_context(generate()),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: event_broker.unsubscribe(subscription))
+    return response
+
+
+'''
+Bulk endpoints
+    accept a list of rows (either the request body itself, or under the
+    'movies'/'actors'/'ids' key), validate every row up front, then write
+    the valid rows in a single transaction. The response reports the
+    outcome of each row by its index in the request.
+
+validate_movie(row, partial) / validate_actor(row, partial)
+    return (values, None) for a valid row, or (None, error message).
+    With partial=True (updates) the row must have an id and fields are
+    optional.
+'''
+
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 10000))
+
+
+def get_bulk_rows(key):
+    body = request.get_json(silent=True)
+    rows = body.get(key, None) if isinstance(body, dict) else body
+    if not isinstance(rows, list) or not 0 < len(rows) <= MAX_BULK_SIZE:
+        abort(400)
+    return rows
+
+
+def validate_id(row, values):
+    row_id = row.get('id', None)
+    if not isinstance(row_id, int) or isinstance(row_id, bool):
+        return 'id must be an integer'
+    values['id'] = row_id
+
+
+def validate_movie(row, partial=False):
+    if not isinstance(row, dict):
+        return None, 'row must be an object'
+    values = {}
+    if partial:
+        error = validate_id(row, values)
+        if error:
+            return None, error
+
+    title = row.get('title', None)
+    if title or not partial:
+        if not isinstance(title, str) or not title.strip():
+            return None, 'title must be a non-empty string'
+        values['title'] = title
+
+    release = row.get('release', None)
+    if release or not partial:
+        try:
+            values['release'] = datetime.datetime.strptime(
+                release, "%d/%m/%Y").date()
+        except (TypeError, ValueError):
+            return None, 'release must be a date of the form DD/MM/YYYY'
+
+    if partial and len(values) == 1:
+        return None, 'no fields to update'
+    return values, None
+
+
+def validate_actor(row, partial=False):
+    if not isinstance(row, dict):
+        return None, 'row must be an object'
+    values = {}
+    if partial:
+        error = validate_id(row, values)
+        if error:
+            return None, error
+
+    name = row.get('name', None)
+    if name or not partial:
+        if not isinstance(name, str) or not name.strip():
+            return None, 'name must be a non-empty string'
+        values['name'] = name
+
+    age = row.get('age', None)
+    if age or not partial:
+        if not isinstance(age, int) or isinstance(age, bool) or age < 0:
+            return None, 'age must be a non-negative integer'
+        values['age'] = age
+
+    gender = row.get('gender', None)
+    if gender or not partial:
+        if not isinstance(gender, str) or len(gender) != 1:
+            return None, 'gender must be a single character'
+        values['gender'] = gender
+
+    if partial and len(values) == 1:
+        return None, 'no fields to update'
+    return values, None
+
+
+def bulk_response(results):
+    results.sort(key=lambda result: result['index'])
+    succeeded = sum(1 for result in results if result['success'])
+    return jsonify({
+        'success': True,
+        'status': 200,
+        'results': results,
+        'total_succeeded': succeeded,
+        'total_failed': len(results) - succeeded
+    })
+
+
+def bulk_create(model, key, validate):
+    results = []
+    valid = []
+    for index, row in enumerate(get_bulk_rows(key)):
+        values, error = validate(row)
+        if error:
+            results.append({'index': index, 'success': False,
+                            'error': error})
+        else:
+            valid.append((index, values))
+
+    if valid:
+        try:
+            ids = bulk_insert(model, [values for _, values in valid])
+        except Exception:
+            abort(422)
+        for (index, _), new_id in zip(valid, ids):
+            results.append({'index': index, 'success': True, 'id': new_id})
+
+    return bulk_response(results)
+
+
+def bulk_modify(model, key, validate):
+    results = []
+    valid = []
+    seen = set()
+    for index, row in enumerate(get_bulk_rows(key)):
+        values, error = validate(row, partial=True)
+        if not error and values['id'] in seen:
+            error = 'duplicate id'
+        if error:
+            results.append({'index': index, 'success': False,
+                            'error': error})
+        else:
+            seen.add(values['id'])
+            valid.append((index, values))
+
+    if valid:
+        try:
+            updated = bulk_update(model, [values for _, values in valid])
+        except Exception:
+            abort(422)
+        for index, values in valid:
+            if values['id'] in updated:
+                results.append({'index': index, 'success': True,
+                                'id': values['id']})
+            else:
+                results.append({'index': index, 'success': False,
+                                'id': values['id'],
+                                'error': 'resource not found'})
+
+    return bulk_response(results)
+
+
+def bulk_remove(model):
+    results = []
+    valid = []
+    for index, row_id in enumerate(get_bulk_rows('ids')):
+        if not isinstance(row_id, int) or isinstance(row_id, bool):
+            results.append({'index': index, 'success': False,
+                            'error': 'id must be an integer'})
+        else:
+            valid.append((index, row_id))
+
+    if valid:
+        try:
+            deleted = bulk_delete(model, [row_id for _, row_id in valid])
+        except Exception:
+            abort(422)
+        for index, row_id in valid:
+            if row_id in deleted:
+                results.append({'index': index, 'success': True,
+                                'id': row_id})
+                # Report repeated ids as not found
+                deleted.discard(row_id)
+            else:
+                results.append({'index': index, 'success': False,
+                                'id': row_id,
+                                'error': 'resource not found'})
+
+    return bulk_response(results)
 
 
 def create_app(test_config=None):
@@ -13,6 +554,9 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    init_metrics(app)
+    init_compression(app)
+    init_admission(app)
 
     @app.route('/')
     def home():
@@ -26,102 +570,466 @@ def create_app(test_config=None):
     # Movies
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @admit('list')
+    @conditional(Movie, Casting, Actor)
+    @cached(Movie, Casting, Actor)
     def get_movies(jwt):
+        if 'ids' in request.args:
+            # Look up the given movies, from the record cache if possible
+            movies = fetch_by_ids(Movie, ids_arg())
+            if not movies:
+                abort(404)
+
+            with timed('encode'):
+                return json_response({
+                    'success': True,
+                    'status': 200,
+                    'movies': [row.format() for row in movies],
+                    'total_movies': len(movies)
+                })
+
         # Query the database
-        movies = Movie.query.order_by(Movie.id).all()
-        movie_list = [movie.format() for movie in movies]
+        expand = expand_arg('cast')
+        if expand:
+            query = filter_movies(select(Movie))
+            movies, next_cursor = paginate(Movie, query.options(
+                selectinload(Movie.cast).joinedload(Casting.actor)),
+                fetch_instances)
+        else:
+            query = filter_movies(Movie.select_rows())
+            movies, next_cursor = paginate(Movie, query, Movie.fetch_rows)
+
+        with timed('serialize'):
+            if expand:
+                movie_list = [
+                    dict(movie.format(), cast=[
+                        casting.format_actor() for casting in movie.cast])
+                    for movie in movies
+                ]
+            else:
+                movie_list = [row.format() for row in movies]
+
+        # A first page with no next page already holds every movie
+        if next_cursor is None and 'after' not in request.args:
+            total_movies = len(movies)
+        else:
+            total_movies = Movie.count(query)
 
-        if len(movies) == 0:
+        if total_movies == 0:
             abort(404)
 
-        return jsonify({
-            'success': True,
-            'status': 200,
-            'movies': movie_list,
-            'total_movies': len(movies)
-        })
+        with timed('encode'):
+            return json_response({
+                'success': True,
+                'status': 200,
+                'movies': movie_list,
+                'total_movies': total_movies,
+                'next_cursor': next_cursor
+            })
 
     # Actors
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @admit('list')
+    @conditional(Actor, Casting, Movie)
+    @cached(Actor, Casting, Movie)
     def get_actors(jwt):
+        if 'ids' in request.args:
+            # Look up the given actors, from the record cache if possible
+            actors = fetch_by_ids(Actor, ids_arg())
+            if not actors:
+                abort(404)
+
+            with timed('encode'):
+                return json_response({
+                    'success': True,
+                    'status': 200,
+                    'actors': [row.format() for row in actors],
+                    'total_actors': len(actors)
+                })
+
         # Query the database
-        actors = Actor.query.order_by(Actor.id).all()
-        actor_list = [actor.format() for actor in actors]
+        expand = expand_arg('movies')
+        if expand:
+            query = filter_actors(select(Actor))
+            actors, next_cursor = paginate(Actor, query.options(
+                selectinload(Actor.roles).joinedload(Casting.movie)),
+                fetch_instances)
+        else:
+            query = filter_actors(Actor.select_rows())
+            actors, next_cursor = paginate(Actor, query, Actor.fetch_rows)
+
+        with timed('serialize'):
+            if expand:
+                actor_list = [
+                    dict(actor.format(), movies=[
+                        casting.format_movie() for casting in actor.roles])
+                    for actor in actors
+                ]
+            else:
+                actor_list = [row.format() for row in actors]
+
+        # A first page with no next page already holds every actor
+        if next_cursor is None and 'after' not in request.args:
+            total_actors = len(actors)
+        else:
+            total_actors = Actor.count(query)
+
+        if total_actors == 0:
+            abort(404)
+
+        with timed('encode'):
+            return json_response({
+                'success': True,
+                'status': 200,
+                'actors': actor_list,
+                'total_actors': total_actors,
+                'next_cursor': next_cursor
+            })
 
-        if len(actors) == 0:
+    # Single records
+    # Movies
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @admit('read')
+    @conditional(Movie)
+    def get_movie(jwt, movie_id):
+        # Served from the record cache if possible
+        movies = fetch_by_ids(Movie, [movie_id])
+        if not movies:
+            # No movie matches movie id
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'status': 200,
+            'movie': movies[0].format()
+        })
+
+    # Actors
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @admit('read')
+    @conditional(Actor)
+    def get_actor(jwt, actor_id):
+        # Served from the record cache if possible
+        actors = fetch_by_ids(Actor, [actor_id])
+        if not actors:
+            # No actor matches actor id
             abort(404)
 
+        return json_response({
+            'success': True,
+            'status': 200,
+            'actor': actors[0].format()
+        })
+
+    # Cast endpoints
+    # Cast of a movie
+    @app.route('/movies/<int:movie_id>/cast', methods=['GET'])
+    @requires_auth('get:movies')
+    @admit('read')
+    @conditional(Movie, Casting, Actor)
+    def get_movie_cast(jwt, movie_id):
+        if Movie.query.filter(Movie.id == movie_id).count() == 0:
+            abort(404)
+
+        cast = Casting.query.filter(Casting.movie_id == movie_id)\
+            .options(joinedload(Casting.actor))\
+            .order_by(Casting.actor_id).all()
+
         return jsonify({
             'success': True,
             'status': 200,
-            'actors': actor_list,
-            'total_actors': len(actors)
+            'movie_id': movie_id,
+            'cast': [casting.format_actor() for casting in cast],
+            'total_cast': len(cast)
         })
 
-    # DELETE endpoints
-    # Movies
-    @app.route('/movies/<int:movie_id>', methods=['DELETE'])
-    @requires_auth('delete:movies')
-    def delete_movie(jwt, movie_id):
-        # Check if movie exists in database
-        movie = Movie.query\
-            .filter(Movie.id == movie_id).one_or_none()
+    # Filmography of an actor
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    @admit('read')
+    @conditional(Actor, Casting, Movie)
+    def get_actor_movies(jwt, actor_id):
+        if Actor.query.filter(Actor.id == actor_id).count() == 0:
+            abort(404)
+
+        roles = Casting.query.filter(Casting.actor_id == actor_id)\
+            .options(joinedload(Casting.movie))\
+            .order_by(Casting.movie_id).all()
+
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'actor_id': actor_id,
+            'movies': [casting.format_movie() for casting in roles],
+            'total_movies': len(roles)
+        })
 
-        if movie:
+    # Add an actor to the cast of a movie
+    @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
+    @requires_auth('patch:movies')
+    @admit('write')
+    def add_movie_cast(jwt, movie_id):
+        body = request.get_json()
+        # Handle error if request is empty or not an object
+        if not body or not isinstance(body, dict):
+            abort(400)
+
+        actor_id = body.get('actor_id', None)
+        role = body.get('role', None)
+        if not isinstance(actor_id, int) or isinstance(actor_id, bool):
+            abort(400)
+        if role is not None and not isinstance(role, str):
+            abort(400)
+
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        if movie is None or actor is None:
+            abort(404)
+
+        try:
+            casting = Casting(movie_id=movie_id, actor_id=actor_id,
+                              role=role)
+            casting.insert()
+
+            return jsonify({
+                'success': True,
+                'status': 200,
+                'movie_id': movie_id,
+                'cast': casting.format_actor()
+            })
+        except:
+            # Actor is already in the cast
+            abort(422)
+
+    # Remove an actor from the cast of a movie
+    @app.route('/movies/<int:movie_id>/cast/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth('patch:movies')
+    @admit('write')
+    def remove_movie_cast(jwt, movie_id, actor_id):
+        casting = Casting.query.filter(Casting.movie_id == movie_id,
+                                       Casting.actor_id == actor_id)\
+            .one_or_none()
+
+        if casting:
             try:
-                # Delete the movie, return the new list of movies
-                movie.delete()
-                movies = Movie.query.order_by(Movie.id).all()
-                movie_list = [movie.format() for movie in movies]
+                casting.delete()
 
                 return jsonify({
                     'success': True,
                     'status': 200,
-                    'deleted_id': movie_id,
-                    'movies': movie_list,
-                    'total_movies': len(movies)
+                    'movie_id': movie_id,
+                    'deleted_actor_id': actor_id
                 })
             except:
-                # Handle error in processing deletion
                 abort(422)
         else:
+            # Actor isn't in the cast of the movie
+            abort(404)
+
+    # Metrics
+    def metrics(jwt=None):
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'response_cache': response_cache.stats(),
+            'record_cache': record_cache.stats(),
+            'token_cache': token_cache.stats(),
+            'database_pool': pool_status(),
+            'database_replicas': replica_pool_status(),
+            'admission': admission_stats(),
+            'events': dict(event_broker.stats(),
+                           transport=event_transport.name),
+            'requests': request_metrics.format()
+        })
+
+    # Executive Producers only, unless METRICS_PUBLIC is set (e.g. for a
+    # scraper that can only reach the app from a private network)
+    if os.environ.get('METRICS_PUBLIC', 'false').lower() != 'true':
+        metrics = requires_auth('delete:movies')(metrics)
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+
+    # Export endpoints
+    # Movies
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    @admit('export')
+    @conditional(Movie)
+    def export_movies(jwt):
+        return export_records(Movie)
+
+    # Actors
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    @admit('export')
+    @conditional(Actor)
+    def export_actors(jwt):
+        return export_records(Actor)
+
+    # Change endpoints
+    # Movies
+    @app.route('/movies/changes', methods=['GET'])
+    @requires_auth('get:movies')
+    @admit('list')
+    @conditional(Movie)
+    @cached(Movie)
+    def get_movie_changes(jwt):
+        since = int_arg('since') or 0
+        movies, deleted, version = fetch_changes(Movie, since)
+
+        with timed('encode'):
+            return json_response({
+                'success': True,
+                'status': 200,
+                'movies': movies,
+                'deleted': deleted,
+                'version': version
+            })
+
+    # Actors
+    @app.route('/actors/changes', methods=['GET'])
+    @requires_auth('get:actors')
+    @admit('list')
+    @conditional(Actor)
+    @cached(Actor)
+    def get_actor_changes(jwt):
+        since = int_arg('since') or 0
+        actors, deleted, version = fetch_changes(Actor, since)
+
+        with timed('encode'):
+            return json_response({
+                'success': True,
+                'status': 200,
+                'actors': actors,
+                'deleted': deleted,
+                'version': version
+            })
+
+    # Event streams
+    # Movies
+    @app.route('/movies/events', methods=['GET'])
+    @requires_auth('get:movies')
+    @admit('stream')
+    def stream_movie_events(jwt):
+        return stream_events(Movie)
+
+    # Actors
+    @app.route('/actors/events', methods=['GET'])
+    @requires_auth('get:actors')
+    @admit('stream')
+    def stream_actor_events(jwt):
+        return stream_events(Actor)
+
+    # Statistics
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:actors')
+    @admit('read')
+    def get_stats(jwt):
+        # Covers movies as well as actors
+        check_permissions('get:movies', jwt)
+        # A few rows of counts kept up to date by every write, see
+        # Statistics in models.py
+        statistics = fetch_statistics()
+        by_gender = statistics['actors_by_gender']
+        by_year = statistics['movies_by_release_year']
+
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'actors': {
+                'total': sum(by_gender.values()),
+                'by_gender': by_gender,
+                'by_age': statistics['actors_by_age']
+            },
+            'movies': {
+                'total': sum(by_year.values()),
+                'by_release_year': by_year
+            }
+        })
+
+    # DELETE endpoints
+    # Movies
+    @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    @admit('write')
+    def delete_movie(jwt, movie_id):
+        try:
+            # Delete the movie in a single statement, returning it
+            deleted_movie = delete_returning(Movie, movie_id)
+        except:
+            # Handle error in processing deletion
+            abort(422)
+
+        if deleted_movie is None:
             # No movie matches movie id
             abort(404)
 
+        if not full_list_requested():
+            return jsonify({
+                'success': True,
+                'status': 200,
+                'deleted_id': movie_id,
+                'movie': deleted_movie.format()
+            })
+
+        # Return the new list of movies if requested
+        movies = Movie.query.order_by(Movie.id).all()
+        movie_list = [movie.format() for movie in movies]
+
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'deleted_id': movie_id,
+            'movie': deleted_movie.format(),
+            'movies': movie_list,
+            'total_movies': len(movies)
+        })
+
     # Actors
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
+    @admit('write')
     def delete_actor(jwt, actor_id):
-        # Check if actor exists in database
-        actor = Actor.query\
-            .filter(Actor.id == actor_id).one_or_none()
-
-        if actor:
-            try:
-                # Delete the actor, return the new list of actors
-                actor.delete()
-                actors = Actor.query.order_by(Actor.id).all()
-                actor_list = [actor.format() for actor in actors]
+        try:
+            # Delete the actor in a single statement, returning it
+            deleted_actor = delete_returning(Actor, actor_id)
+        except:
+            # Handle error in processing deletion
+            abort(422)
 
-                return jsonify({
-                    'success': True,
-                    'status': 200,
-                    'deleted_id': actor_id,
-                    'actors': actor_list,
-                    'total_actors': len(actors)
-                })
-            except:
-                # Handle error in processing deletion
-                abort(422)
-        else:
+        if deleted_actor is None:
             # No actor matches actor id
             abort(404)
 
+        if not full_list_requested():
+            return jsonify({
+                'success': True,
+                'status': 200,
+                'deleted_id': actor_id,
+                'actor': deleted_actor.format()
+            })
+
+        # Return the new list of actors if requested
+        actors = Actor.query.order_by(Actor.id).all()
+        actor_list = [actor.format() for actor in actors]
+
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'deleted_id': actor_id,
+            'actor': deleted_actor.format(),
+            'actors': actor_list,
+            'total_actors': len(actors)
+        })
+
     # POST endpoints
     # Movies
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @admit('write')
     def create_movie(jwt):
         body = request.get_json()
         # Handle error if request is empty
@@ -144,6 +1052,15 @@ def create_app(test_config=None):
             movie.insert()
 
             # Return success message with created movie id
+            if not full_list_requested():
+                return jsonify({
+                    'success': True,
+                    'status': 200,
+                    'created_movie': movie.id,
+                    'movie': movie.format()
+                })
+
+            # Return the new list of movies if requested
             movies = Movie.query.order_by(Movie.id).all()
             movie_list = [movie.format() for movie in movies]
 
@@ -151,6 +1068,7 @@ def create_app(test_config=None):
                 'success': True,
                 'status': 200,
                 'created_movie': movie.id,
+                'movie': movie.format(),
                 'movies': movie_list,
                 'total_movies': len(movies)
             })
@@ -160,6 +1078,7 @@ def create_app(test_config=None):
     # Actors
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @admit('write')
     def create_actor(jwt):
         body = request.get_json()
         # Handle error if request is empty
@@ -179,6 +1098,15 @@ def create_app(test_config=None):
             actor.insert()
 
             # Return success message with created actor id
+            if not full_list_requested():
+                return jsonify({
+                    'success': True,
+                    'status': 200,
+                    'created_actor': actor.id,
+                    'actor': actor.format()
+                })
+
+            # Return the new list of actors if requested
             actors = Actor.query.order_by(Actor.id).all()
             actor_list = [actor.format() for actor in actors]
 
@@ -186,98 +1114,136 @@ def create_app(test_config=None):
                 'success': True,
                 'status': 200,
                 'created_actor': actor.id,
+                'actor': actor.format(),
                 'actors': actor_list,
                 'total_actors': len(actors)
             })
         except:
             abort(422)
 
+    # Bulk endpoints
+    # Movies
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @admit('bulk')
+    def bulk_create_movies(jwt):
+        return bulk_create(Movie, 'movies', validate_movie)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    @admit('bulk')
+    def bulk_update_movies(jwt):
+        return bulk_modify(Movie, 'movies', validate_movie)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    @admit('bulk')
+    def bulk_delete_movies(jwt):
+        return bulk_remove(Movie)
+
+    # Actors
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @admit('bulk')
+    def bulk_create_actors(jwt):
+        return bulk_create(Actor, 'actors', validate_actor)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    @admit('bulk')
+    def bulk_update_actors(jwt):
+        return bulk_modify(Actor, 'actors', validate_actor)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    @admit('bulk')
+    def bulk_delete_actors(jwt):
+        return bulk_remove(Actor)
+
     # PATCH endpoints
     # Movies
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @admit('write')
     def update_movie(jwt, movie_id):
-        # Get movie from database
-        movie = Movie.query\
-            .filter(Movie.id == movie_id).one_or_none()
-
-        if movie:
-            body = request.get_json()
-            if body == {}:
-                abort(400)
+        body = request.get_json()
+        if body == {}:
+            abort(400)
 
-            # Get updated details from request
-            new_title = body.get('title', None)
-            new_release = body.get('release', None)
-
-            # Set new details to movie
-            if new_title:
-                movie.title = new_title
-            if new_release:
-                try:
-                    release_datetime = datetime.datetime.strptime(
-                        new_release, "%d/%m/%Y"
-                    )
-                    new_release = release_datetime.date()
-                except:
-                    abort(400)
-                movie.release = new_release
+        # Get updated details from request
+        new_title = body.get('title', None)
+        new_release = body.get('release', None)
 
+        # Collect the new details of the movie
+        values = {}
+        if new_title:
+            values['title'] = new_title
+        if new_release:
             try:
-                movie.update()
-
-                # Return success message
-                return jsonify({
-                    'success': True,
-                    'status': 200,
-                    'updated_movie': [movie.format()]
-                })
+                release_datetime = datetime.datetime.strptime(
+                    new_release, "%d/%m/%Y"
+                )
+                values['release'] = release_datetime.date()
             except:
-                abort(422)
-        else:
+                abort(400)
+
+        try:
+            # Update the movie in a single statement, returning it
+            movie = update_returning(Movie, movie_id, values)
+        except:
+            abort(422)
+
+        if movie is None:
             # Movie doesn't exist in database
             abort(404)
 
+        # Return success message
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'updated_movie': [movie.format()]
+        })
+
     # Actors
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
+    @admit('write')
     def update_actor(jwt, actor_id):
-        # Get actor from database
-        actor = Actor.query\
-            .filter(Actor.id == actor_id).one_or_none()
+        body = request.get_json()
+        if body == {}:
+            abort(400)
 
-        if actor:
-            body = request.get_json()
-            if body == {}:
-                abort(400)
+        # Get updated details from request
+        new_name = body.get('name', None)
+        new_age = body.get('age', None)
+        new_gender = body.get('gender', None)
 
-            # Get updated details from request
-            new_name = body.get('name', None)
-            new_age = body.get('age', None)
-            new_gender = body.get('gender', None)
-            # Set new details to actor
-            if new_name:
-                actor.name = new_name
-            if new_age:
-                actor.age = new_age
-            if new_gender:
-                actor.gender = new_gender
+        # Collect the new details of the actor
+        values = {}
+        if new_name:
+            values['name'] = new_name
+        if new_age:
+            values['age'] = new_age
+        if new_gender:
+            values['gender'] = new_gender
 
-            try:
-                actor.update()
+        try:
+            # Update the actor in a single statement, returning it
+            actor = update_returning(Actor, actor_id, values)
+        except:
+            abort(422)
 
-                # Return success message
-                return jsonify({
-                    'success': True,
-                    'status': 200,
-                    'updated_actor': [actor.format()]
-                })
-            except:
-                abort(422)
-        else:
+        if actor is None:
             # Actor doesn't exist in database
             abort(404)
 
+        # Return success message
+        return jsonify({
+            'success': True,
+            'status': 200,
+            'updated_actor': [actor.format()]
+        })
+
     # Error handlers
     # 404
     @app.errorhandler(400)
@@ -320,6 +1286,14 @@ def create_app(test_config=None):
             'message': 'internal server error'
         }), 500
 
+    @app.errorhandler(AdmissionError)
+    def admission_error(error):
+        return jsonify({
+            'success': False,
+            'status': error.status_code,
+            'message': error.error
+        }), error.status_code, {'Retry-After': str(error.retry_after)}
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         print(error)
@@ -332,7 +1306,6 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
-
 if __name__ == '__main__':
+    app = create_app()
     app.run(host='0.0.0.0', port=8080, debug=True)
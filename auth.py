@@ -3,11 +3,36 @@ from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from collections import OrderedDict
+from threading import Lock, Thread
+import hashlib
+import time
 import os
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+from metrics import timed
+
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+'''
+Auth0 settings
+Read from the environment when a token is first verified rather than on
+import, so the app can be imported and built without them.
+'''
+
+
+def auth0_domain():
+    return os.environ['AUTH0_DOMAIN']
+
+
+def jwks_url():
+    # JWKS location can be overridden (e.g. file:///path/jwks.json for testing)
+    return os.environ.get(
+        'JWKS_URL', f'https://{auth0_domain()}/.well-known/jwks.json')
+
 
 # AuthError Exception
 '''
@@ -22,6 +47,169 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Key Store
+'''
+JWKSKeyStore
+Loads the signing keys once and keeps them in memory.
+Keys are refreshed when the TTL expires, or when a token arrives with
+an unknown kid (no more than once per min_refresh_interval seconds).
+Once the TTL expires the old keys keep being served while a background
+thread refetches them, so requests only wait on the network for the
+first load or an unknown kid.
+If a refresh fails the previously loaded keys continue to be served.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url=None, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.loaded_at = None
+        self.last_attempt = None
+        self.lock = Lock()
+        # Held while a background refresh runs
+        self.background = Lock()
+
+    def fetch(self):
+        jsonurl = urlopen(self.url or jwks_url(), timeout=JWKS_FETCH_TIMEOUT)
+        jwks = json.loads(jsonurl.read())
+        return {key['kid']: key for key in jwks['keys'] if 'kid' in key}
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            # Another thread may have refreshed while we were waiting
+            if not force and self.loaded_at is not None \
+                    and now - self.loaded_at < self.ttl:
+                return
+            # Rate limit refetches so unknown kids can't stampede the IdP
+            if self.last_attempt is not None \
+                    and now - self.last_attempt < self.min_refresh_interval:
+                return
+            self.last_attempt = now
+            try:
+                self.keys = self.fetch()
+                self.loaded_at = now
+            except Exception:
+                # Keep serving stale keys if we have any
+                if not self.keys:
+                    raise AuthError('Unable to fetch signing keys', 503)
+
+    def refresh_in_background(self):
+        # Skip while a refetch would be rate limited, e.g. after a failed
+        # refresh during an IdP outage, so requests don't each start a
+        # thread
+        if self.last_attempt is not None and time.monotonic() - \
+                self.last_attempt < self.min_refresh_interval:
+            return
+        # Skip if a refresh is already running
+        if not self.background.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            except AuthError:
+                pass
+            finally:
+                self.background.release()
+
+        Thread(target=run, daemon=True).start()
+
+    def get_key(self, kid):
+        if self.loaded_at is None:
+            self.refresh()
+        elif time.monotonic() - self.loaded_at >= self.ttl:
+            self.refresh_in_background()
+        if not self.keys:
+            raise AuthError('Unable to fetch signing keys', 503)
+        key = self.keys.get(kid)
+        if key is None:
+            # Possible key rotation, try refetching the key set
+            self.refresh(force=True)
+            key = self.keys.get(kid)
+        return key
+
+    def clear(self):
+        with self.lock:
+            self.keys = {}
+            self.loaded_at = None
+            self.last_attempt = None
+
+
+jwks_store = JWKSKeyStore()
+
+
+# Verified Token Cache
+'''
+TokenCache
+A bounded LRU of verified token payloads, keyed by a hash of the token.
+Entries expire at the token's exp claim, so a cached payload is never
+served for longer than the token itself would have been accepted.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, payload = entry
+            if time.time() >= expires_at:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload):
+        # Tokens without an expiry are never cached
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return
+        key = self.key(token)
+        with self.lock:
+            self.entries[key] = (payload['exp'], payload)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 
 def get_token_auth_header():
@@ -60,32 +248,29 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
 
     if 'kid' not in unverified_header:
         raise AuthError('Malformed header', 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = jwks_store.get_key(unverified_header['kid'])
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=os.environ['ALGORITHMS'],
+                audience=os.environ['API_AUDIENCE'],
+                issuer='https://' + auth0_domain() + '/'
             )
 
             return payload
@@ -110,9 +295,14 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                # Skip signature verification for recently verified tokens
+                payload = token_cache.get(token)
+                if payload is None:
+                    payload = verify_decode_jwt(token)
+                    token_cache.set(token, payload)
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
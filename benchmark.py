@@ -0,0 +1,478 @@
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import rsa
+from jose import jwt
+
+'''
+Benchmark suite
+Runs every route of the app in-process against a local database, using
+tokens signed by a locally generated key and a matching JWKS file, so no
+network access or Auth0 tenant is needed.
+
+Usage:
+    python benchmark.py --movies 1000 --actors 1000 --requests 200 \\
+        --output results.json
+    python benchmark.py --compare results.json
+
+Results are written as JSON, with latency percentiles (milliseconds),
+throughput and the largest number of SQL queries per request for each
+route (except streamed responses, whose queries run after the
+Server-Timing header is sent), and the time taken to start the app.
+With --compare, routes whose p50 latency has grown by more than
+--threshold against a previous results file are reported and the
+script exits with status 1.
+'''
+
+AUDIENCE = 'agency'
+DOMAIN = 'benchmark.local'
+KEY_ID = 'benchmark'
+PERMISSIONS = [
+    'get:movies', 'get:actors',
+    'post:movies', 'post:actors',
+    'patch:movies', 'patch:actors',
+    'delete:movies', 'delete:actors'
+]
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+'''
+setup_auth(directory)
+    generates a key pair, writes the public key as a JWKS file and points
+    the app at it. Returns a function minting tokens signed by the key.
+'''
+
+
+def setup_auth(directory):
+    public_key, private_key = rsa.newkeys(2048)
+    jwks_path = os.path.join(directory, 'jwks.json')
+    with open(jwks_path, 'w') as f:
+        json.dump({'keys': [{
+            'kty': 'RSA',
+            'kid': KEY_ID,
+            'use': 'sig',
+            'n': b64_int(public_key.n),
+            'e': b64_int(public_key.e)
+        }]}, f)
+
+    os.environ['AUTH0_DOMAIN'] = DOMAIN
+    os.environ['ALGORITHMS'] = 'RS256'
+    os.environ['API_AUDIENCE'] = AUDIENCE
+    os.environ['JWKS_URL'] = 'file://' + os.path.abspath(jwks_path)
+    pem = private_key.save_pkcs1().decode()
+
+    def mint_token(permissions=PERMISSIONS, lifetime=3600):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': f'https://{DOMAIN}/',
+            'sub': 'benchmark|user',
+            'aud': AUDIENCE,
+            'iat': now,
+            'exp': now + lifetime,
+            'permissions': permissions
+        }, pem, algorithm='RS256', headers={'kid': KEY_ID})
+
+    return mint_token
+
+
+def seed(movie_count, actor_count, cast_size):
+    from models import db, Movie, Actor, Casting, bulk_insert
+
+    db.drop_all()
+    db.create_all()
+    start = datetime.date(1950, 1, 1)
+    bulk_insert(Movie, [
+        {'title': f'Movie {i}',
+         'release': start + datetime.timedelta(days=i % 25000)}
+        for i in range(movie_count)
+    ])
+    bulk_insert(Actor, [
+        {'name': f'Actor {i}', 'age': 18 + i % 70, 'gender': 'MFO'[i % 3]}
+        for i in range(actor_count)
+    ])
+    # Castings have no id, so they are added without bulk_insert
+    db.session.bulk_insert_mappings(Casting, [
+        {'movie_id': movie + 1,
+         'actor_id': (movie * cast_size + i) % actor_count + 1,
+         'role': f'Role {i}'}
+        for movie in range(movie_count)
+        for i in range(min(cast_size, actor_count))
+    ])
+    db.session.commit()
+
+
+'''
+Routes
+Each case returns (method, path, json body) for its nth request,
+covering every route in create_app. The DELETE and POST
+/movies/<id>/cast cases use rows set aside for them by prepare_case, so
+every request does the same amount of work.
+
+Event streams never end, so their cases add a write as a fourth item:
+run_case opens the stream, makes the write and times the request until
+the write's event arrives, then closes the stream.
+'''
+
+BULK_SIZE = 100
+
+
+def build_cases(movie_count, actor_count, deletable):
+    new_movie = {'title': 'Benchmark Movie', 'release': '01/01/2020'}
+    new_actor = {'name': 'Benchmark Actor', 'age': 30, 'gender': 'F'}
+    bulk_size = BULK_SIZE
+    middle_movie = max(movie_count // 2, 1)
+
+    return {
+        'GET /': lambda n: ('GET', '/', None),
+        'GET /login': lambda n: ('GET', '/login', None),
+        'GET /metrics': lambda n: ('GET', '/metrics', None),
+        'GET /movies': lambda n: ('GET', '/movies', None),
+        'GET /movies?limit=50': lambda n: ('GET', '/movies?limit=50', None),
+        'GET /movies?limit=50&after=middle': lambda n: (
+            'GET', f'/movies?limit=50&after={middle_movie}', None),
+        'GET /actors': lambda n: ('GET', '/actors', None),
+        'GET /actors?limit=50': lambda n: ('GET', '/actors?limit=50', None),
+        'GET /movies?limit=10&expand=cast': lambda n: (
+            'GET', '/movies?limit=10&expand=cast', None),
+        'GET /movies?limit=100&expand=cast': lambda n: (
+            'GET', '/movies?limit=100&expand=cast', None),
+        'GET /actors?limit=100&expand=movies': lambda n: (
+            'GET', '/actors?limit=100&expand=movies', None),
+        'GET /movies/<id>': lambda n: (
+            'GET', f'/movies/{n % movie_count + 1}', None),
+        'GET /actors/<id>': lambda n: (
+            'GET', f'/actors/{n % actor_count + 1}', None),
+        'GET /movies?ids=10': lambda n: (
+            'GET', '/movies?ids=' + ','.join(
+                str((n + i) % movie_count + 1) for i in range(10)), None),
+        'GET /movies/<id>/cast': lambda n: (
+            'GET', f'/movies/{n % movie_count + 1}/cast', None),
+        'GET /actors/<id>/movies': lambda n: (
+            'GET', f'/actors/{n % actor_count + 1}/movies', None),
+        'GET /movies/export': lambda n: ('GET', '/movies/export', None),
+        'GET /actors/export': lambda n: ('GET', '/actors/export', None),
+        'GET /movies/changes': lambda n: ('GET', '/movies/changes', None),
+        'GET /actors/changes': lambda n: ('GET', '/actors/changes', None),
+        'GET /stats': lambda n: ('GET', '/stats', None),
+        'GET /movies/events': lambda n: (
+            'GET', '/movies/events', None,
+            ('PATCH', f'/movies/{n % movie_count + 1}',
+             {'title': f'Movie {n}'})),
+        'GET /actors/events': lambda n: (
+            'GET', '/actors/events', None,
+            ('PATCH', f'/actors/{n % actor_count + 1}',
+             {'age': 18 + n % 70})),
+        'POST /movies': lambda n: ('POST', '/movies', new_movie),
+        'POST /actors': lambda n: ('POST', '/actors', new_actor),
+        'PATCH /movies/<id>': lambda n: (
+            'PATCH', f'/movies/{n % movie_count + 1}',
+            {'title': f'Movie {n}'}),
+        'PATCH /actors/<id>': lambda n: (
+            'PATCH', f'/actors/{n % actor_count + 1}', {'age': 18 + n % 70}),
+        'DELETE /movies/<id>': lambda n: (
+            'DELETE', '/movies/{}'.format(deletable['movies'][n]), None),
+        'DELETE /actors/<id>': lambda n: (
+            'DELETE', '/actors/{}'.format(deletable['actors'][n]), None),
+        'POST /movies/bulk': lambda n: (
+            'POST', '/movies/bulk', [new_movie] * bulk_size),
+        'POST /actors/bulk': lambda n: (
+            'POST', '/actors/bulk', [new_actor] * bulk_size),
+        'PATCH /movies/bulk': lambda n: (
+            'PATCH', '/movies/bulk',
+            [{'id': i + 1, 'title': f'Movie {n}'}
+             for i in range(min(bulk_size, movie_count))]),
+        'PATCH /actors/bulk': lambda n: (
+            'PATCH', '/actors/bulk',
+            [{'id': i + 1, 'age': 18 + n % 70}
+             for i in range(min(bulk_size, actor_count))]),
+        'DELETE /movies/bulk': lambda n: (
+            'DELETE', '/movies/bulk',
+            deletable['movies'][n * bulk_size:(n + 1) * bulk_size]),
+        'DELETE /actors/bulk': lambda n: (
+            'DELETE', '/actors/bulk',
+            deletable['actors'][n * bulk_size:(n + 1) * bulk_size]),
+        'POST /movies/<id>/cast': lambda n: (
+            'POST', '/movies/{}/cast'.format(deletable['movies'][n]),
+            {'actor_id': deletable['actors'][n - 1],
+             'role': 'Benchmark Role'}),
+        'DELETE /movies/<id>/cast/<id>': lambda n: (
+            'DELETE', '/movies/{}/cast/{}'.format(*deletable['castings'][n]),
+            None),
+    }
+
+
+'''
+prepare_case(deletable, route, requests)
+    sets aside the rows used by the route's requests, if it needs any
+'''
+
+
+def prepare_case(deletable, route, requests):
+    cast = route in ('POST /movies/<id>/cast',
+                     'DELETE /movies/<id>/cast/<id>')
+    if route.startswith('DELETE') or cast:
+        rows = requests
+        if route.endswith('/bulk'):
+            rows *= BULK_SIZE
+        prepare_deletes(deletable, rows, cast)
+
+
+def prepare_deletes(deletable, rows, cast=False):
+    from models import db, Movie, Actor, Casting, bulk_insert
+
+    deletable['movies'] = bulk_insert(Movie, [
+        {'title': 'Benchmark Movie', 'release': datetime.date(2020, 1, 1)}
+    ] * rows)
+    deletable['actors'] = bulk_insert(Actor, [
+        {'name': 'Benchmark Actor', 'age': 30, 'gender': 'F'}
+    ] * rows)
+    if cast:
+        # Each new movie gets the new actor with the same index, so
+        # POST /movies/<id>/cast adds the actor before it
+        deletable['castings'] = list(zip(deletable['movies'],
+                                         deletable['actors']))
+        db.session.bulk_insert_mappings(Casting, [
+            {'movie_id': movie_id, 'actor_id': actor_id,
+             'role': 'Benchmark Role'}
+            for movie_id, actor_id in deletable['castings']
+        ])
+        db.session.commit()
+
+
+# Number of SQL queries reported in the Server-Timing header
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def percentile(values, fraction):
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def send(client, headers, case, n):
+    method, path, body, *write = case(n)
+    if not write:
+        response = client.open(path, method=method, json=body,
+                               headers=headers)
+        # Consume streamed bodies so their cost is included
+        response.get_data()
+        return response
+
+    response = client.open(path, method=method, json=body,
+                           headers=headers)
+    chunks = iter(response.response)
+    # The stream opens with a comment, then the write's event follows
+    next(chunks)
+    write_method, write_path, write_body = write[0]
+    client.open(write_path, method=write_method, json=write_body,
+                headers=headers)
+    for chunk in chunks:
+        if chunk.startswith(b'id:'):
+            break
+    response.close()
+    return response
+
+
+def run_case(client, headers, case, requests, warmup):
+    for n in range(warmup):
+        send(client, headers, case, requests + n)
+
+    latencies = []
+    statuses = {}
+    queries = []
+    started = time.perf_counter()
+    for n in range(requests):
+        request_start = time.perf_counter()
+        response = send(client, headers, case, n)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        # Streamed responses (with no Content-Length) send Server-Timing
+        # before their body runs its queries, so they have no query count
+        if 'Content-Length' in response.headers:
+            match = QUERIES.search(
+                response.headers.get('Server-Timing', ''))
+            queries.append(int(match.group(1)) if match else 0)
+        statuses[response.status_code] = \
+            statuses.get(response.status_code, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'statuses': {str(code): count for code, count in statuses.items()},
+        'throughput_rps': round(requests / elapsed, 2),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p90_ms': round(percentile(latencies, 0.90), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'max_queries': max(queries) if queries else None
+    }
+
+
+'''
+measure_startup(runs)
+    median time, in milliseconds, for a fresh interpreter to import the
+    app and build it, as each gunicorn worker does on boot
+'''
+
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+from app import create_app
+create_app()
+print(time.perf_counter() - start)
+'''
+
+
+def measure_startup(runs):
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(float(output) * 1000)
+    times.sort()
+    return round(percentile(times, 0.50), 3)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for route, result in results['routes'].items():
+        previous = baseline['routes'].get(route)
+        if previous is None or not previous['p50_ms']:
+            continue
+        change = result['p50_ms'] / previous['p50_ms'] - 1
+        if change > threshold:
+            regressions.append((route, previous['p50_ms'],
+                                result['p50_ms'], change))
+
+    for route, before, after, change in regressions:
+        print(f'REGRESSION {route}: p50 {before:.3f}ms -> {after:.3f}ms '
+              f'(+{change:.0%})')
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the casting agency API offline.')
+    parser.add_argument('--movies', type=int, default=1000,
+                        help='number of movies to seed (default 1000)')
+    parser.add_argument('--actors', type=int, default=1000,
+                        help='number of actors to seed (default 1000)')
+    parser.add_argument('--cast-size', type=int, default=5,
+                        help='actors cast in each movie (default 5)')
+    parser.add_argument('--response-cache', default='none',
+                        help='RESPONSE_CACHE backend to run with (default '
+                             'none, so reads are measured against the '
+                             'database)')
+    parser.add_argument('--admission-store', default='none',
+                        help='ADMISSION_STORE to run with (default none, '
+                             'so requests are never rate limited or shed)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route (default 200)')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests per route (default 20)')
+    parser.add_argument('--database', default=None,
+                        help='database URL (default: a temporary SQLite '
+                             'file). The database is dropped and reseeded')
+    parser.add_argument('--routes', default=None,
+                        help='comma separated list of routes to run')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='app startups to time (default 5, 0 to '
+                             'skip)')
+    parser.add_argument('--output', default=None,
+                        help='write the results as JSON to this file')
+    parser.add_argument('--compare', default=None,
+                        help='previous results file to check against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='p50 growth reported as a regression '
+                             '(default 0.2, i.e. 20%%)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='agency-benchmark-')
+    mint_token = setup_auth(directory)
+    os.environ['DATABASE_URL'] = args.database or \
+        'sqlite:///' + os.path.join(directory, 'benchmark.sqlite')
+    os.environ['RESPONSE_CACHE'] = args.response_cache
+    os.environ['ADMISSION_STORE'] = args.admission_store
+
+    # The response cache and admission store are chosen on import
+    from app import create_app
+    app = create_app()
+
+    deletable = {}
+    cases = build_cases(args.movies, args.actors, deletable)
+    if args.routes:
+        selected = [route.strip() for route in args.routes.split(',')]
+        cases = {route: cases[route] for route in selected}
+
+    headers = {'Authorization': 'Bearer ' + mint_token()}
+    client = app.test_client()
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+        'movies': args.movies,
+        'actors': args.actors,
+        'cast_size': args.cast_size,
+        'response_cache': args.response_cache,
+        'admission_store': args.admission_store,
+        'routes': {}
+    }
+
+    if args.startup_runs:
+        results['startup_ms'] = measure_startup(args.startup_runs)
+        print('{:<40} {:>9.3f}ms'.format('startup', results['startup_ms']))
+
+    with app.app_context():
+        seed(args.movies, args.actors, args.cast_size)
+        for route, case in cases.items():
+            prepare_case(deletable, route, args.requests + args.warmup)
+            result = run_case(client, headers, case,
+                              args.requests, args.warmup)
+            results['routes'][route] = result
+            queries = result['max_queries']
+            print('{:<40} {:>9.1f} req/s  p50 {:>8.3f}ms  '
+                  'p99 {:>8.3f}ms  queries {:>3}'.format(
+                      route, result['throughput_rps'], result['p50_ms'],
+                      result['p99_ms'], '-' if queries is None else queries))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
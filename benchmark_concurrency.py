@@ -0,0 +1,255 @@
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Lock, Thread
+
+from benchmark import setup_auth, seed, build_cases, prepare_case, \
+    percentile, git_commit
+
+'''
+Concurrency benchmark
+Serves the app with gunicorn once for each worker class, and sends
+requests from many concurrent clients, to compare how many requests a
+worker can keep in flight. Authentication uses a locally generated key,
+as in benchmark.py, so no network access or Auth0 tenant is needed.
+
+Usage:
+    python benchmark_concurrency.py --worker-classes sync,gevent \\
+        --concurrency 50 --requests 2000 --output concurrency.json
+    python benchmark_concurrency.py \\
+        --database postgresql://localhost:5432/agency_benchmark
+
+The async worker only helps while requests wait on the network: with
+the default SQLite database every query runs in-process, so use
+--database with a PostgreSQL server (ideally a remote one) to see the
+difference.
+'''
+
+DEFAULT_ROUTES = 'GET /movies?limit=50,GET /movies/<id>/cast'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+'''
+start_server(worker_class, workers, port, log)
+    starts gunicorn with the app and waits until it answers requests. The
+    worker class and number of workers are passed in the environment, as
+    in production, so gunicorn.conf.py sets the server up the same way
+'''
+
+
+def start_server(worker_class, workers, port, log):
+    env = dict(os.environ, WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:create_app()',
+         '--bind', f'127.0.0.1:{port}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'gunicorn ({worker_class}) exited with '
+                               f'status {server.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'gunicorn ({worker_class}) did not start')
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+'''
+run_load(port, headers, case, requests, concurrency, timeout)
+    sends the case's requests from concurrency client threads, each
+    waiting for its response before sending the next request
+'''
+
+
+def run_load(port, headers, case, requests, concurrency, timeout):
+    lock = Lock()
+    counter = iter(range(requests))
+    latencies = []
+    statuses = {}
+
+    def client():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            method, path, body = case(n)
+            request_headers = dict(headers)
+            data = None
+            if body is not None:
+                data = json.dumps(body)
+                request_headers['Content-Type'] = 'application/json'
+
+            request_start = time.perf_counter()
+            try:
+                connection = http.client.HTTPConnection(
+                    '127.0.0.1', port, timeout=timeout)
+                connection.request(method, path, body=data,
+                                   headers=request_headers)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                status = str(response.status)
+            except OSError:
+                status = 'error'
+            latency = (time.perf_counter() - request_start) * 1000
+            with lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'statuses': statuses,
+        'throughput_rps': round(requests / elapsed, 2),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p90_ms': round(percentile(latencies, 0.90), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3)
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare gunicorn worker classes under concurrent load.')
+    parser.add_argument('--worker-classes', default='sync,gevent',
+                        help='comma separated gunicorn worker classes '
+                             '(default sync,gevent)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes per server (default 1)')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='concurrent clients (default 50)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per route (default 1000)')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds before a request counts as an error '
+                             '(default 30)')
+    parser.add_argument('--movies', type=int, default=1000,
+                        help='number of movies to seed (default 1000)')
+    parser.add_argument('--actors', type=int, default=1000,
+                        help='number of actors to seed (default 1000)')
+    parser.add_argument('--cast-size', type=int, default=5,
+                        help='actors cast in each movie (default 5)')
+    parser.add_argument('--response-cache', default='none',
+                        help='RESPONSE_CACHE backend to run with '
+                             '(default none)')
+    parser.add_argument('--admission-store', default='none',
+                        help='ADMISSION_STORE to run with (default none, '
+                             'so requests are never rate limited or shed)')
+    parser.add_argument('--database', default=None,
+                        help='database URL (default: a temporary SQLite '
+                             'file). The database is dropped and reseeded')
+    parser.add_argument('--routes', default=DEFAULT_ROUTES,
+                        help='comma separated list of routes from '
+                             'benchmark.py (default {})'.format(
+                                 DEFAULT_ROUTES.replace('%', '%%')))
+    parser.add_argument('--output', default=None,
+                        help='write the results as JSON to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='agency-concurrency-')
+    mint_token = setup_auth(directory)
+    os.environ['DATABASE_URL'] = args.database or \
+        'sqlite:///' + os.path.join(directory, 'benchmark.sqlite')
+    os.environ['RESPONSE_CACHE'] = args.response_cache
+    os.environ['ADMISSION_STORE'] = args.admission_store
+
+    # The response cache and admission store are chosen on import
+    from app import create_app
+    app = create_app()
+
+    deletable = {}
+    cases = build_cases(args.movies, args.actors, deletable)
+    routes = [route.strip() for route in args.routes.split(',')]
+    # Event streams stay open, so they can't be sent as plain requests
+    streams = [route for route in routes if route.endswith('/events')]
+    if streams:
+        sys.exit('Event streams are measured by benchmark.py only: '
+                 + ', '.join(streams))
+    headers = {'Authorization': 'Bearer ' + mint_token()}
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'servers': {}
+    }
+
+    with app.app_context():
+        seed(args.movies, args.actors, args.cast_size)
+
+    for worker_class in args.worker_classes.split(','):
+        worker_class = worker_class.strip()
+        port = free_port()
+        log_path = os.path.join(directory, f'gunicorn-{worker_class}.log')
+        with open(log_path, 'w') as log:
+            server = start_server(worker_class, args.workers, port, log)
+            try:
+                results['servers'][worker_class] = {}
+                for route in routes:
+                    with app.app_context():
+                        prepare_case(deletable, route, args.requests)
+                    result = run_load(port, headers, cases[route],
+                                      args.requests, args.concurrency,
+                                      args.timeout)
+                    results['servers'][worker_class][route] = result
+                    print('{:<8} {:<36} {:>9.1f} req/s  p50 {:>9.3f}ms  '
+                          'p99 {:>9.3f}ms  errors {}'.format(
+                              worker_class, route, result['throughput_rps'],
+                              result['p50_ms'], result['p99_ms'],
+                              result['statuses'].get('error', 0)))
+            finally:
+                stop_server(server)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+'''
+Response cache
+Stores the encoded bodies of GET responses, so repeated reads can be
+served without querying the database or encoding JSON.
+
+Keys start with the table name and the table's current version (see
+versions.py), so a write makes every existing entry for the table
+unreachable. Backends also drop a table's entries when invalidate(table)
+is called from the model write methods.
+
+Every backend provides get(key), set(key, value), invalidate(table),
+clear() and stats().
+'''
+
+
+'''
+LocalCache
+An in-process LRU, bounded by the total size of the cached bodies.
+'''
+
+
+class LocalCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.bytes -= len(old_value)
+            self.entries[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def invalidate(self, table):
+        prefix = table + '-'
+        with self.lock:
+            for key in [key for key in self.entries
+                        if key.startswith(prefix)]:
+                self.bytes -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'local',
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+'''
+SharedCache
+Base class for caches shared by several worker processes (e.g. Redis or
+memcached). Subclasses implement fetch(key), store(key, value, ttl) and
+flush(); hit and miss counting is done here, per process.
+
+Because keys are versioned, a shared backend doesn't need to delete
+entries when a table changes: stale entries are never read again and
+expire after the TTL.
+'''
+
+
+class SharedCache:
+    name = 'shared'
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key):
+        raise NotImplementedError
+
+    def store(self, key, value, ttl):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def get(self, key):
+        value = self.fetch(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.store(key, value, self.ttl)
+
+    def invalidate(self, table):
+        pass
+
+    def clear(self):
+        self.flush()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+'''
+MemorySharedCache
+A SharedCache kept in a dict, standing in for a real shared store in
+tests and local development.
+'''
+
+
+class MemorySharedCache(SharedCache):
+    name = 'memory'
+
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        self.values = {}
+
+    def fetch(self, key):
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            self.values.pop(key, None)
+            return None
+        return value
+
+    def store(self, key, value, ttl):
+        self.values[key] = (time.monotonic() + ttl, value)
+
+    def flush(self):
+        self.values.clear()
+
+
+'''
+NullCache
+Used when RESPONSE_CACHE is set to 'none'.
+'''
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def invalidate(self, table):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'none'}
+
+
+'''
+get_response_cache()
+    chooses the backend from RESPONSE_CACHE: 'local' (default), 'memory'
+    or 'none'
+'''
+
+
+def get_response_cache():
+    backend = os.environ.get('RESPONSE_CACHE', 'local').lower()
+    if backend == 'none':
+        return NullCache()
+    if backend == 'memory':
+        return MemorySharedCache(
+            int(os.environ.get('RESPONSE_CACHE_TTL', 300)))
+    return LocalCache(
+        int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024)))
+
+
+response_cache = get_response_cache()
+
+
+'''
+Record cache
+A bounded per-process LRU of single records (the rows returned by
+Model.fetch_rows), keyed by table and id, serving GET /movies/<id>,
+GET /actors/<id> and ?ids= lookups without a database round trip.
+
+Each entry is stored with the table's version when it was read, and is
+only served while the table is still at that version, so a write in
+another worker process expires it as well (with VERSION_STORE_DIR set,
+see versions.py). The model write methods also drop the records they
+change straight away with invalidate(table, ids).
+'''
+
+
+class RecordCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get_many(self, table, ids, version):
+        found = {}
+        with self.lock:
+            for id in ids:
+                entry = self.entries.get((table, id))
+                if entry is None or entry[0] != version:
+                    self.misses += 1
+                    continue
+                self.entries.move_to_end((table, id))
+                found[id] = entry[1]
+                self.hits += 1
+        return found
+
+    def set_many(self, table, records, version):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            for id, record in records.items():
+                self.entries[(table, id)] = (version, record)
+                self.entries.move_to_end((table, id))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, table, ids):
+        with self.lock:
+            for id in ids:
+                self.entries.pop((table, id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+record_cache = RecordCache(int(os.environ.get('RECORD_CACHE_SIZE', 10000)))
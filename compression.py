@@ -0,0 +1,147 @@
+import os
+import zlib
+
+from flask import request
+
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+Compresses response bodies with brotli or gzip, whichever the client
+prefers in its Accept-Encoding header (brotli on a tie). Brotli is only
+offered when the brotli package is installed.
+
+Bodies smaller than COMPRESSION_MIN_SIZE bytes are sent as they are.
+Streamed responses, such as the exports, are compressed as they are
+sent. The compressor is flushed once COMPRESSION_FLUSH_SIZE bytes have
+gone in since the last flush, so the client receives rows steadily
+while the compressor still works on large runs of data; flushing every
+small chunk ends a compressed block each time and makes the body much
+larger.
+'''
+
+COMPRESSION_ENABLED = \
+    os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+COMPRESSION_FLUSH_SIZE = int(
+    os.environ.get('COMPRESSION_FLUSH_SIZE', 64 * 1024))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson',
+                      'text/html', 'text/plain')
+
+
+class GzipCompressor:
+    encoding = 'gzip'
+
+    def __init__(self):
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    encoding = 'br'
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+COMPRESSORS = {'gzip': GzipCompressor}
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+
+
+def choose_encoding():
+    return request.accept_encodings.best_match(
+        [encoding for encoding in ('br', 'gzip') if encoding in COMPRESSORS])
+
+
+def compress_stream(chunks, compressor):
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= COMPRESSION_FLUSH_SIZE:
+                data += compressor.flush()
+                pending = 0
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    if request.method == 'HEAD' or response.status_code < 200 or \
+            response.status_code in (204, 304) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return response
+    if not response.is_streamed and \
+            response.calculate_content_length() < COMPRESSION_MIN_SIZE:
+        return response
+
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    compressor = COMPRESSORS[encoding]()
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        with timed('compress'):
+            response.set_data(compressor.compress(response.get_data()) +
+                              compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+
+    # The compressed body differs byte for byte from the uncompressed one
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+'''
+init_compression(app)
+    registers response compression on the app, unless COMPRESSION_ENABLED
+    is set to false
+'''
+
+
+def init_compression(app):
+    if COMPRESSION_ENABLED:
+        app.after_request(compress_response)
@@ -0,0 +1,188 @@
+import os
+import queue
+from threading import Lock
+
+'''
+Change events
+Every committed insert, update and delete of a movie or actor is
+published as an event:
+    {'id': '42.1', 'version': 42, 'table': 'Movies', 'type': 'update',
+     'record_id': 1, 'record': {...}}
+Delete events have no record. The version is the write's change version
+(see Change tracking in models.py), which the events of a single write,
+such as a bulk insert, share. Within a write events are published in
+record id order, so the id '<version>.<record id>' orders every event of
+a table and a stream can resume part way through a write.
+
+Events are published through a transport, which carries them to the
+broker of every worker process. The broker then fans them out to the
+subscriptions of the event streams open in its process.
+'''
+
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+
+
+'''
+Subscription
+A bounded queue of events for one open stream. A subscriber that falls
+more than EVENT_QUEUE_SIZE events behind is marked as overflowed rather
+than holding up the publisher; its stream then ends, and the client
+catches up from the change log when it reconnects.
+'''
+
+
+class Subscription:
+    def __init__(self, table, maxsize):
+        self.table = table
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+'''
+EventBroker
+Fans events out to the subscriptions of this process.
+'''
+
+
+class EventBroker:
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscriptions = set()
+        self.delivered = 0
+        self.lock = Lock()
+
+    def subscribe(self, table):
+        subscription = Subscription(table, self.queue_size)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def deliver(self, event):
+        with self.lock:
+            subscriptions = [subscription
+                             for subscription in self.subscriptions
+                             if subscription.table == event['table']]
+            self.delivered += 1
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscriptions),
+                'delivered': self.delivered
+            }
+
+
+'''
+EventTransport
+Base class for carrying events between worker processes. Subclasses
+implement publish(event), sending the event to every worker (e.g. with
+Redis pub/sub or PostgreSQL LISTEN/NOTIFY), and call broker.deliver(event)
+for each event received, including those published by their own process.
+
+LocalTransport delivers straight to this process's broker, which is
+enough for a single worker and for tests. NullTransport drops events.
+'''
+
+
+class EventTransport:
+    name = 'transport'
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, event):
+        raise NotImplementedError
+
+
+class LocalTransport(EventTransport):
+    name = 'local'
+
+    def publish(self, event):
+        self.broker.deliver(event)
+
+
+class NullTransport(EventTransport):
+    name = 'none'
+
+    def publish(self, event):
+        pass
+
+
+'''
+get_event_transport(broker)
+    chooses the transport from EVENT_TRANSPORT: 'local' (default) or
+    'none'
+'''
+
+
+def get_event_transport(broker):
+    transport = os.environ.get('EVENT_TRANSPORT', 'local').lower()
+    if transport == 'none':
+        return NullTransport(broker)
+    return LocalTransport(broker)
+
+
+event_broker = EventBroker()
+event_transport = get_event_transport(event_broker)
+
+
+'''
+change_event(table, type, version, record_id, record)
+    builds an 'insert', 'update' or 'delete' event for a record
+publish_change(table, type, version, record_id, record)
+    publishes one, once its write has been committed
+parse_event_id(value)
+    parses an event id into a cursor, (version, record id). A bare
+    version, such as the one returned by GET /movies/changes, gives
+    (version, None), meaning the whole of that version
+after_cursor(event, cursor)
+    whether the event comes after the cursor
+'''
+
+
+def change_event(table, type, version, record_id, record=None):
+    event = {
+        'id': '{}.{}'.format(version, record_id),
+        'version': version,
+        'table': table,
+        'type': type,
+        'record_id': record_id
+    }
+    if record is not None:
+        event['record'] = record
+    return event
+
+
+def publish_change(table, type, version, record_id, record=None):
+    event_transport.publish(
+        change_event(table, type, version, record_id, record))
+
+
+def parse_event_id(value):
+    version, _, record_id = value.partition('.')
+    return int(version), int(record_id) if record_id else None
+
+
+def after_cursor(event, cursor):
+    version, record_id = cursor
+    if record_id is None:
+        return event['version'] > version
+    return (event['version'], event['record_id']) > cursor
@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+'''
+Gunicorn settings
+Loaded automatically by `gunicorn "app:create_app()"` (see the Procfile).
+
+WORKER_CLASS selects how each worker process serves requests:
+- sync (default): one request at a time per worker
+- gevent: many concurrent requests per worker. Each request runs in a
+  greenlet, and blocking network calls (the JWKS fetch, database
+  queries on PostgreSQL) yield to other requests instead of holding up
+  the worker. Requires gevent (in requirements.txt); without it the
+  server falls back to sync workers
+
+The hooks below check the settings gunicorn ended up with, so they also
+apply when the worker class or number of workers is given on the
+command line (--worker-class, --workers).
+'''
+
+worker_class = os.environ.get('WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        print('WORKER_CLASS=gevent needs `pip install gevent`, '
+              'using sync workers')
+        worker_class = 'sync'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Greenlets per gevent worker
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+
+
+
+def on_starting(server):
+    # Workers must share the table versions (see versions.py), or after
+    # one worker writes the others keep serving their cached responses,
+    # records and ETags. Set in the master, before the workers are forked
+    # and import the app
+    if server.cfg.workers > 1 and not os.environ.get('VERSION_STORE_DIR'):
+        os.environ['VERSION_STORE_DIR'] = tempfile.mkdtemp(
+            prefix='agency-versions-')
+
+
+def gevent_wait_callback(conn, timeout=None):
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError('Bad result from poll: %r' % state)
+
+
+def post_fork(server, worker):
+    # psycopg2 blocks in C, so gevent can't switch greenlets during a
+    # query unless it waits on the socket through this callback
+    postgres = os.environ.get('DATABASE_URL', '').startswith('postgres')
+    if server.cfg.worker_class_str == 'gevent' and postgres:
+        try:
+            from psycopg2 import extensions
+        except ImportError:
+            return
+        extensions.set_wait_callback(gevent_wait_callback)
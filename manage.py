@@ -1,13 +1,23 @@
-from flask_script import Manager
+from flask_script import Manager, Command
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
-from models import db
+from app import create_app
+from models import db, refresh_statistics
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class RefreshStats(Command):
+    """Recount the statistics served by GET /stats"""
+
+    def run(self):
+        refresh_statistics()
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('refresh_stats', RefreshStats())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+import os
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Request instrumentation
+Records how long each request spends in each phase (auth, sql,
+serialize, encode and total), along with the number of SQL queries run.
+The timings of each request are returned in a Server-Timing header and
+aggregated into per-route histograms, exposed at GET /metrics.
+'''
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def format(self):
+        buckets = {str(bound): count
+                   for bound, count in zip(BUCKETS, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'buckets': buckets
+        }
+
+
+'''
+RequestMetrics
+Histograms of phase durations (in milliseconds), keyed by route and
+phase, plus a histogram of the number of queries per request.
+'''
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = Lock()
+
+    def observe(self, route, phase, value):
+        with self.lock:
+            histogram = self.histograms.get((route, phase))
+            if histogram is None:
+                histogram = self.histograms[(route, phase)] = Histogram()
+            histogram.observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def format(self):
+        with self.lock:
+            routes = {}
+            for (route, phase), histogram in self.histograms.items():
+                routes.setdefault(route, {})[phase] = histogram.format()
+            return routes
+
+
+request_metrics = RequestMetrics()
+
+
+'''
+timed(phase)
+    context manager adding the time spent in the block to the current
+    request's timing for the phase. Does nothing outside a request.
+'''
+
+
+def record_phase(phase, seconds):
+    timings = getattr(g, 'timings', None) if has_app_context() else None
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, perf_counter() - start)
+
+
+# SQLAlchemy engine events
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info['query_start'].pop()
+    record_phase('sql', perf_counter() - start)
+    if has_app_context() and getattr(g, 'timings', None) is not None:
+        g.query_count += 1
+
+
+def handle_error(context):
+    # A failed query gets no after_cursor_execute, so drop its start time
+    # here, or the next query on the connection would be timed from it
+    if context.connection is None:
+        return
+    starts = context.connection.info.get('query_start')
+    if starts:
+        record_phase('sql', perf_counter() - starts.pop())
+
+
+# Request hooks
+def start_request():
+    g.timings = {}
+    g.query_count = 0
+    g.request_start = perf_counter()
+
+
+def finish_request(response):
+    timings = getattr(g, 'timings', None)
+    if timings is None:
+        return response
+    timings['total'] = perf_counter() - g.request_start
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    route = '{} {}'.format(request.method, route)
+    entries = []
+    for phase, seconds in timings.items():
+        ms = seconds * 1000
+        request_metrics.observe(route, phase, ms)
+        if phase == 'sql':
+            entries.append('sql;dur={:.2f};desc="{} queries"'.format(
+                ms, g.query_count))
+        else:
+            entries.append('{};dur={:.2f}'.format(phase, ms))
+    request_metrics.observe(route, 'queries', g.query_count)
+
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+'''
+init_metrics(app)
+    registers the request hooks on the app and the SQL listeners on all
+    engines, unless METRICS_ENABLED is set to false
+'''
+
+
+def init_metrics(app):
+    if not METRICS_ENABLED:
+        return
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
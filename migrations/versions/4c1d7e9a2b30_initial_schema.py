@@ -0,0 +1,45 @@
+"""initial schema
+
+Revision ID: 4c1d7e9a2b30
+Revises:
+Create Date: 2026-10-18 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1d7e9a2b30'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases set up before migrations were added already have these
+    # tables (created by db.create_all), so only create missing ones
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'Movies' not in tables:
+        op.create_table(
+            'Movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release', sa.Date(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'Actors' not in tables:
+        op.create_table(
+            'Actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(length=1), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('Actors')
+    op.drop_table('Movies')
@@ -0,0 +1,69 @@
+"""statistics table, counted from the existing movies and actors
+
+Revision ID: 7c2f9d4b1e63
+Revises: d5a81c3f9e24
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from collections import Counter
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2f9d4b1e63'
+down_revision = 'd5a81c3f9e24'
+branch_labels = None
+depends_on = None
+
+
+# As in models.py at this revision
+def age_band(age):
+    if age is None:
+        return 'unknown'
+    lower = 0
+    for upper in (18, 30, 40, 50, 60):
+        if age < upper:
+            return '{}-{}'.format(lower, upper - 1)
+        lower = upper
+    return '{}+'.format(lower)
+
+
+STATISTICS = (
+    ('Movies', 'movies_by_release_year', sa.column('release', sa.Date),
+     lambda release: str(release.year) if release is not None
+     else 'unknown'),
+    ('Actors', 'actors_by_gender', sa.column('gender', sa.String),
+     lambda gender: gender or 'unknown'),
+    ('Actors', 'actors_by_age', sa.column('age', sa.Integer), age_band),
+)
+
+
+def upgrade():
+    connection = op.get_bind()
+    if 'Statistics' in sa.inspect(connection).get_table_names():
+        return
+    statistics = op.create_table(
+        'Statistics',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('count', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'key')
+    )
+
+    counts = Counter()
+    for table, name, column, key in STATISTICS:
+        for value, count in connection.execute(
+                sa.select(column, sa.func.count())
+                .select_from(sa.table(table, column)).group_by(column)):
+            counts[(name, key(value))] += count
+    if counts:
+        op.bulk_insert(statistics, [
+            {'name': name, 'key': key, 'count': count}
+            for (name, key), count in counts.items()
+        ])
+
+
+def downgrade():
+    op.drop_table('Statistics')
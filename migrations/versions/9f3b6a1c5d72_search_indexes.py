@@ -0,0 +1,49 @@
+"""search indexes on movies and actors
+
+Revision ID: 9f3b6a1c5d72
+Revises: 4c1d7e9a2b30
+Create Date: 2026-10-18 18:25:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f3b6a1c5d72'
+down_revision = '4c1d7e9a2b30'
+branch_labels = None
+depends_on = None
+
+
+def create_index(name, table, columns, **kwargs):
+    # Tables created by db.create_all may already have the index
+    existing = sa.inspect(op.get_bind()).get_indexes(table)
+    if name not in [index['name'] for index in existing]:
+        op.create_index(name, table, columns, **kwargs)
+
+
+def upgrade():
+    # Trigram indexes serve the case-insensitive substring and prefix
+    # filters on PostgreSQL. Other databases get a plain index instead.
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    create_index('ix_movies_title_trgm', 'Movies', ['title'],
+                 postgresql_using='gin',
+                 postgresql_ops={'title': 'gin_trgm_ops'})
+    create_index('ix_movies_release', 'Movies', ['release'])
+
+    create_index('ix_actors_name_trgm', 'Actors', ['name'],
+                 postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'})
+    create_index('ix_actors_age', 'Actors', ['age'])
+    create_index('ix_actors_gender_age', 'Actors', ['gender', 'age'])
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_age', table_name='Actors')
+    op.drop_index('ix_actors_age', table_name='Actors')
+    op.drop_index('ix_actors_name_trgm', table_name='Actors')
+    op.drop_index('ix_movies_release', table_name='Movies')
+    op.drop_index('ix_movies_title_trgm', table_name='Movies')
@@ -0,0 +1,40 @@
+"""castings linking actors to movies
+
+Revision ID: b27e4d8f0a16
+Revises: 9f3b6a1c5d72
+Create Date: 2026-10-18 18:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b27e4d8f0a16'
+down_revision = '9f3b6a1c5d72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created by db.create_all may already have the table
+    if 'Castings' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'Castings',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('role', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['actor_id'], ['Actors.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['movie_id'], ['Movies.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_Castings_actor_id'), 'Castings', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Castings_actor_id'), table_name='Castings')
+    op.drop_table('Castings')
@@ -0,0 +1,80 @@
+"""change versions on movies and actors, with tombstones for deletes
+
+Revision ID: d5a81c3f9e24
+Revises: b27e4d8f0a16
+Create Date: 2026-10-18 19:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a81c3f9e24'
+down_revision = 'b27e4d8f0a16'
+branch_labels = None
+depends_on = None
+
+
+# Databases created by db.create_all may already have these
+def add_column(table, column):
+    existing = sa.inspect(op.get_bind()).get_columns(table)
+    if column.name not in [col['name'] for col in existing]:
+        op.add_column(table, column)
+
+
+def create_index(name, table, columns):
+    existing = sa.inspect(op.get_bind()).get_indexes(table)
+    if name not in [index['name'] for index in existing]:
+        op.create_index(name, table, columns)
+
+
+def upgrade():
+    # Existing rows start at version 0, before any tracked change
+    for table, index in (('Movies', 'ix_movies_version'),
+                         ('Actors', 'ix_actors_version')):
+        add_column(table, sa.Column('version', sa.BigInteger(),
+                                    nullable=False, server_default='0'))
+        add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                    nullable=True))
+        create_index(index, table, ['version'])
+
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'ChangeCounters' not in tables:
+        op.create_table(
+            'ChangeCounters',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.BigInteger(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    # The counter's single row, created here so concurrent first writes
+    # only ever update it
+    counters = sa.table('ChangeCounters', sa.column('id', sa.Integer),
+                        sa.column('version', sa.BigInteger))
+    if op.get_bind().execute(sa.select(counters.c.id)
+                             .where(counters.c.id == 1)).first() is None:
+        op.bulk_insert(counters, [{'id': 1, 'version': 0}])
+    if 'Tombstones' not in tables:
+        op.create_table(
+            'Tombstones',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('table_name', sa.String(), nullable=False),
+            sa.Column('record_id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.BigInteger(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_tombstones_table_version', 'Tombstones',
+                        ['table_name', 'version'])
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_table_version', table_name='Tombstones')
+    op.drop_table('Tombstones')
+    op.drop_table('ChangeCounters')
+    for table, index in (('Actors', 'ix_actors_version'),
+                         ('Movies', 'ix_movies_version')):
+        op.drop_index(index, table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')
@@ -1,28 +1,557 @@
-from sqlalchemy import Column, String, Integer, Date, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, BigInteger, Date, DateTime, \
+    create_engine, func, event, exc, Index, DDL, ForeignKey, select, \
+    insert, update, delete, inspect, tuple_, bindparam
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
+from flask import request, g, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from collections import namedtuple, Counter
+import datetime
 import json
 import os
+import random
+import time
 
-# Replace postgres with postgresql to enable app to work with SQLALchemy > 1.4
-database_path = os.environ['DATABASE_URL']
+from versions import version_store
+from cache import response_cache, record_cache
+from events import change_event, publish_change, after_cursor
+from metrics import timed
 
-if database_path.startswith("postgres://"):
-    database_path = database_path.replace("postgres://", "postgresql://", 1)
+'''
+Read replicas
+Set DB_REPLICA_URLS to a comma separated list of database URLs to send
+the queries of GET requests to a replica, picked at random for each
+request. Everything else, and anything flushed by the ORM (the model
+insert, update and delete methods), goes to the primary DATABASE_URL.
+
+GET requests read from the primary instead when they send an
+X-Read-From: primary header, for read-your-writes consistency, or when
+a table was written to in the last DB_REPLICA_LAG seconds (default 1),
+so ETags and cached responses are never built from a replica that
+hasn't caught up with a write yet.
+'''
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+
+def replica_urls():
+    return [url.strip() for url in
+            os.environ.get('DB_REPLICA_URLS', '').split(',') if url.strip()]
+
+
+def replica_binds(app):
+    return [bind for bind in app.config.get('SQLALCHEMY_BINDS') or {}
+            if bind.startswith(REPLICA_BIND_PREFIX)]
+
+
+def recently_written(lag):
+    now = time.time()
+    for table in db.metadata.tables:
+        changed_at = version_store.changed_at(table)
+        if changed_at is not None and now - changed_at < lag:
+            return True
+    return False
+
+
+def replica_engine():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return None
+    if 'db_replica' not in g:
+        binds = replica_binds(current_app)
+        wants_primary = \
+            request.headers.get('X-Read-From', '').lower() == 'primary'
+        if not binds or wants_primary \
+                or recently_written(current_app.config['DB_REPLICA_LAG']):
+            g.db_replica = None
+        else:
+            g.db_replica = db.get_engine(bind=random.choice(binds))
+    return g.db_replica
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        if not self._flushing:
+            replica = replica_engine()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
 
-db = SQLAlchemy()
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 '''
+database_url()
+    reads the database location from DATABASE_URL
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. Nothing is sent
+    to the database until the first query: the schema is created by the
+    migrations (python manage.py db upgrade), not on startup.
 '''
 
 
-def setup_db(app, database_path=database_path):
+def database_url():
+    database_path = os.environ['DATABASE_URL']
+    # Replace postgres with postgresql to enable app to work with
+    # SQLALchemy > 1.4
+    if database_path.startswith("postgres://"):
+        database_path = database_path.replace(
+            "postgres://", "postgresql://", 1)
+    return database_path
+
+
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = database_url()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    app.config["SQLALCHEMY_BINDS"] = {
+        '{}{}'.format(REPLICA_BIND_PREFIX, i): url
+        for i, url in enumerate(replica_urls())
+    }
+    app.config["DB_REPLICA_LAG"] = float(
+        os.environ.get('DB_REPLICA_LAG', 1))
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+'''
+Connection pool
+engine_options(database_path)
+    builds the engine options from the environment:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds),
+    DB_POOL_RECYCLE (seconds), DB_POOL_PRE_PING (true/false) and
+    DB_STATEMENT_TIMEOUT (milliseconds, PostgreSQL only).
+    SQLite keeps SQLAlchemy's default pool.
+'''
+
+
+def env_flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+def engine_options(database_path):
+    options = {
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', 'true')
+    }
+    if database_path.startswith('sqlite'):
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    })
+    statement_timeout = os.environ.get('DB_STATEMENT_TIMEOUT', None)
+    if statement_timeout and database_path.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(int(statement_timeout))
+        }
+    return options
+
+
+'''
+TimedQueuePool
+A QueuePool recording the time spent waiting for a connection as the
+'pool' phase of the current request (see metrics.py).
+'''
+
+
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        with timed('pool'):
+            return super()._do_get()
+
+
+def pool_status(engine=None):
+    pool = (engine or db.engine).pool
+    if not isinstance(pool, QueuePool):
+        return {'class': type(pool).__name__}
+    return {
+        'class': type(pool).__name__,
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow()
+    }
+
+
+def replica_pool_status():
+    return {bind: pool_status(db.get_engine(bind=bind))
+            for bind in replica_binds(current_app)}
+
+
+# Connections are tagged with the process that opened them. A connection
+# inherited across a fork (e.g. gunicorn --preload) is discarded without
+# being closed, so the parent's socket is left alone and the worker opens
+# its own connection.
+@event.listens_for(Pool, 'connect')
+def record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record,
+                         connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.dbapi_connection = \
+            connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError(
+            'Connection belongs to pid {}, attempting to check out in '
+            'pid {}'.format(connection_record.info['pid'], pid))
+
+
+'''
+Read queries
+Read-only list queries are built as select() statements.
+
+fetch_instances(stmt)
+    runs an entity select (e.g. select(Movie)) through the session,
+    returning ORM instances
+Model.select_rows() / Model.fetch_rows(stmt)
+    build and run a select of just the columns returned by format(). These
+    run on the session's connection without the ORM, so no instances are
+    created or tracked in the identity map, and return compact named tuple
+    rows (MovieRow, ActorRow) which have the same format() method.
+Model.count(stmt)
+    counts the rows matched by a select, without fetching them
+
+These model methods come from RowQueries, shared by Movie and Actor,
+which set format_columns (the columns returned by format()) and row_type
+(a row class made with make_row_type).
+'''
+
+
+def fetch_instances(stmt):
+    return db.session.execute(stmt).scalars().all()
+
+
+def make_row_type(name, columns):
+    class Row(namedtuple(name, columns)):
+        __slots__ = ()
+
+        def format(self):
+            return self._asdict()
+
+    Row.__name__ = Row.__qualname__ = name
+    return Row
+
+
+class RowQueries:
+    format_columns = ()
+    row_type = None
+
+    @classmethod
+    def count(cls, stmt=None):
+        stmt = stmt if stmt is not None else select(cls)
+        return db.session.execute(
+            stmt.with_only_columns(func.count(cls.id)).order_by(None)
+        ).scalar()
+
+    @classmethod
+    def select_rows(cls):
+        return select(*(cls.__table__.c[name] for name in cls.format_columns))
+
+    @classmethod
+    def fetch_rows(cls, stmt):
+        make_row = cls.row_type._make
+        return [make_row(row) for row in db.session.connection().execute(stmt)]
+
+
+'''
+record_changed(table, ids)
+    called after every committed write to a table. Bumps the table's
+    version and drops its cached responses, and the cached records of the
+    ids written to
+'''
+
+
+def record_changed(table, ids=()):
+    version_store.bump(table)
+    response_cache.invalidate(table)
+    record_cache.invalidate(table, ids)
+
+
+'''
+fetch_by_ids(model, ids)
+    returns the rows of the given ids, in the order given, skipping ids
+    that don't exist. Rows in the record cache are served from memory and
+    the rest are fetched with a single IN query, then cached.
+'''
+
+
+def fetch_by_ids(model, ids):
+    table = model.__tablename__
+    # Read before querying, so rows fetched during a write are tagged
+    # with the older version and never served
+    version = version_store.get(table)
+    records = record_cache.get_many(table, ids, version)
+    missing = [id for id in ids if id not in records]
+    if missing:
+        fetched = {row.id: row for row in model.fetch_rows(
+            model.select_rows().where(model.id.in_(missing)))}
+        record_cache.set_many(table, fetched, version)
+        records.update(fetched)
+    return [records[id] for id in ids if id in records]
+
+
+'''
+Bulk operations
+    write many rows of a model in a single transaction, with a statement
+    per chunk of rows (or an executemany) rather than one unit of work
+    per row.
+
+bulk_insert(model, rows)
+    inserts a list of column dicts, returning the new ids in order. Rows
+    are sent BULK_INSERT_CHUNK_SIZE at a time as multi-row INSERTs; see
+    insert_rows
+bulk_update(model, rows)
+    updates a list of column dicts (each including its id), returning the
+    ids that were updated. Rows whose id does not exist are skipped
+bulk_delete(model, ids)
+    deletes the given ids, returning the ids that were deleted
+'''
+
+
+BULK_INSERT_CHUNK_SIZE = int(os.environ.get('BULK_INSERT_CHUNK_SIZE', 100))
+
+
+'''
+insert_rows(connection, table, rows)
+    inserts the rows with one multi-row INSERT per chunk, returning their
+    ids in order. With RETURNING (PostgreSQL) the ids are read back from
+    each INSERT. SQLite has no RETURNING before SQLAlchemy 2.0, but
+    numbers the rows of a single INSERT consecutively, so they end at the
+    INSERT's lastrowid. Any other database gets an INSERT per row.
+'''
+
+
+def insert_rows(connection, table, rows):
+    # Every row of a multi-row INSERT needs the same columns
+    names = sorted(set().union(*rows))
+    rows = [{name: row.get(name) for name in names} for row in rows]
+    ids = []
+    for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + BULK_INSERT_CHUNK_SIZE]
+        if supports_returning(connection):
+            # Ids are drawn from the sequence in the order of the rows
+            ids.extend(sorted(connection.execute(
+                insert(table).values(chunk).returning(table.c.id))
+                .scalars()))
+        elif connection.dialect.name == 'sqlite':
+            last = connection.execute(insert(table).values(chunk)).lastrowid
+            ids.extend(range(last - len(chunk) + 1, last + 1))
+        else:
+            for row in chunk:
+                ids.append(connection.execute(
+                    insert(table).values(row)).inserted_primary_key[0])
+    return ids
+
+
+def fetch_previous(model, ids):
+    return {row.id: row for row in model.fetch_rows(
+        model.select_rows().where(model.id.in_(ids)))}
+
+
+def bulk_insert(model, rows):
+    try:
+        connection = db.session.connection()
+        version = next_change_version(connection)
+        updated_at = datetime.datetime.utcnow()
+        rows = [dict(row, version=version, updated_at=updated_at)
+                for row in rows]
+        ids = insert_rows(connection, model.__table__, rows)
+        deltas = Counter()
+        for row, row_id in zip(rows, ids):
+            row['id'] = row_id
+            count_statistics(deltas, model.__tablename__, row, 1)
+        apply_statistics(connection, deltas)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    record_changed(model.__tablename__)
+    make_row = model.row_type._make
+    for row in rows:
+        record = make_row(row.get(name) for name in model.format_columns)
+        publish_change(model.__tablename__, 'insert', version, row['id'],
+                       record.format())
+    return ids
+
+
+def bulk_update(model, rows):
+    try:
+        connection = db.session.connection()
+        version = next_change_version(connection)
+        # Read once the counter is held, for the changes to the statistics
+        previous = fetch_previous(model, [row['id'] for row in rows])
+        found = set(previous)
+        updated_at = datetime.datetime.utcnow()
+        db.session.bulk_update_mappings(
+            model, [dict(row, version=version, updated_at=updated_at)
+                    for row in rows if row['id'] in found])
+        # The rows are partial, so read the updated records for the events
+        updated = model.fetch_rows(
+            model.select_rows().where(model.id.in_(found))
+            .order_by(model.id)) if found else []
+        deltas = Counter()
+        for row in updated:
+            count_statistics(deltas, model.__tablename__,
+                             previous[row.id]._asdict(), -1)
+            count_statistics(deltas, model.__tablename__, row._asdict(), 1)
+        apply_statistics(connection, deltas)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if found:
+        record_changed(model.__tablename__, found)
+    for row in updated:
+        publish_change(model.__tablename__, 'update', version, row.id,
+                       row.format())
+    return found
+
+
+def bulk_delete(model, ids):
+    try:
+        connection = db.session.connection()
+        version = next_change_version(connection)
+        previous = fetch_previous(model, ids)
+        found = set(previous)
+        deltas = Counter()
+        for row in previous.values():
+            count_statistics(deltas, model.__tablename__, row._asdict(), -1)
+        apply_statistics(connection, deltas)
+        # Remove the cast entries of the deleted rows as well
+        Casting.query.filter(Casting.column_for(model).in_(found))\
+            .delete(synchronize_session=False)
+        model.query.filter(model.id.in_(found))\
+            .delete(synchronize_session=False)
+        add_tombstones(connection, model.__tablename__, found, version,
+                       datetime.datetime.utcnow())
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if found:
+        record_changed(model.__tablename__, found)
+        record_changed(Casting.__tablename__)
+    for id in sorted(found):
+        publish_change(model.__tablename__, 'delete', version, id)
+    return found
+
+
+'''
+Single statement writes
+update_returning(model, id, values)
+    updates a row and returns it as a row tuple, or None if the id does
+    not exist
+delete_returning(model, id)
+    deletes a row (and its cast entries) and returns it as a row tuple,
+    or None if the id does not exist
+On databases supporting UPDATE/DELETE ... RETURNING (PostgreSQL) the row
+is written and read back in a single statement, with cast entries removed
+by the foreign key's ON DELETE CASCADE. Elsewhere the row is read within
+the same transaction. Both also stamp the change version and update the
+counts (see Change tracking and Statistics); updates to a counted column
+read its previous value first.
+'''
+
+
+def supports_returning(connection):
+    return connection.dialect.full_returning
+
+
+def update_returning(model, id, values):
+    table = model.__table__
+    columns = [table.c[name] for name in model.format_columns]
+    by_id = table.c.id == id
+    try:
+        connection = db.session.connection()
+        previous = None
+        if values:
+            values = dict(values, version=next_change_version(connection),
+                          updated_at=datetime.datetime.utcnow())
+            if any(column.name in values
+                   for column in statistic_columns(model)):
+                # Read once the counter is held, for the statistics
+                previous = connection.execute(
+                    select(*statistic_columns(model)).where(by_id))\
+                    .mappings().first()
+        if not values:
+            row = connection.execute(select(*columns).where(by_id)).first()
+        elif supports_returning(connection):
+            row = connection.execute(
+                update(table).where(by_id).values(values)
+                .returning(*columns)).first()
+        else:
+            result = connection.execute(
+                update(table).where(by_id).values(values))
+            row = connection.execute(select(*columns).where(by_id))\
+                .first() if result.rowcount else None
+        if previous is not None and row is not None:
+            deltas = Counter()
+            count_statistics(deltas, table.name, previous, -1)
+            count_statistics(deltas, table.name, row._mapping, 1)
+            apply_statistics(connection, deltas)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if row is None:
+        return None
+    row = model.row_type._make(row)
+    if values:
+        record_changed(table.name, [id])
+        publish_change(table.name, 'update', values['version'], id,
+                       row.format())
+    return row
+
+
+def delete_returning(model, id):
+    table = model.__table__
+    columns = [table.c[name] for name in model.format_columns]
+    by_id = table.c.id == id
+    try:
+        connection = db.session.connection()
+        version = next_change_version(connection)
+        if supports_returning(connection):
+            row = connection.execute(
+                delete(table).where(by_id).returning(*columns)).first()
+        else:
+            row = connection.execute(select(*columns).where(by_id)).first()
+            if row is not None:
+                connection.execute(delete(Casting.__table__).where(
+                    Casting.column_for(model) == id))
+                if not connection.execute(delete(table).where(by_id))\
+                        .rowcount:
+                    row = None
+        if row is not None:
+            add_tombstones(connection, table.name, [id], version,
+                           datetime.datetime.utcnow())
+            deltas = Counter()
+            count_statistics(deltas, table.name, row._mapping, -1)
+            apply_statistics(connection, deltas)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if row is None:
+        return None
+    record_changed(table.name, [id])
+    record_changed(Casting.__tablename__)
+    publish_change(table.name, 'delete', version, id)
+    return model.row_type._make(row)
 
 
 '''
@@ -31,12 +560,27 @@ Have title and release date
 '''
 
 
-class Movie(db.Model):
+MovieRow = make_row_type('MovieRow', ('id', 'title', 'release'))
+
+
+class Movie(RowQueries, db.Model):
     __tablename__ = "Movies"
+    __table_args__ = (
+        Index('ix_movies_title_trgm', 'title', postgresql_using='gin',
+              postgresql_ops={'title': 'gin_trgm_ops'}),
+        Index('ix_movies_release', 'release'),
+        Index('ix_movies_version', 'version'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release = Column(Date)
+    # Set on every write, see Change tracking
+    version = Column(BigInteger, nullable=False, default=0,
+                     server_default='0')
+    updated_at = Column(DateTime)
+    cast = relationship('Casting', back_populates='movie',
+                        cascade='all, delete-orphan')
 
     def __init__(self, title, release):
         self.title = title
@@ -45,13 +589,26 @@ class Movie(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        record_changed(self.__tablename__)
+        publish_change(self.__tablename__, 'insert', self.version, self.id,
+                       self.format())
 
     def update(self):
         db.session.commit()
+        record_changed(self.__tablename__, [self.id])
+        publish_change(self.__tablename__, 'update', self.version, self.id,
+                       self.format())
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        record_changed(self.__tablename__, [self.id])
+        record_changed(Casting.__tablename__)
+        publish_change(self.__tablename__, 'delete', self.version, self.id)
+
+    # Columns returned by format(), for queries that skip ORM instances
+    format_columns = MovieRow._fields
+    row_type = MovieRow
 
     def format(self):
         return {
@@ -67,13 +624,29 @@ Have name, age and gender
 '''
 
 
-class Actor(db.Model):
+ActorRow = make_row_type('ActorRow', ('id', 'name', 'age', 'gender'))
+
+
+class Actor(RowQueries, db.Model):
     __tablename__ = "Actors"
+    __table_args__ = (
+        Index('ix_actors_name_trgm', 'name', postgresql_using='gin',
+              postgresql_ops={'name': 'gin_trgm_ops'}),
+        Index('ix_actors_age', 'age'),
+        Index('ix_actors_gender_age', 'gender', 'age'),
+        Index('ix_actors_version', 'version'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
     gender = Column(String(1))
+    # Set on every write, see Change tracking
+    version = Column(BigInteger, nullable=False, default=0,
+                     server_default='0')
+    updated_at = Column(DateTime)
+    roles = relationship('Casting', back_populates='actor',
+                         cascade='all, delete-orphan')
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -83,13 +656,26 @@ class Actor(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        record_changed(self.__tablename__)
+        publish_change(self.__tablename__, 'insert', self.version, self.id,
+                       self.format())
 
     def update(self):
         db.session.commit()
+        record_changed(self.__tablename__, [self.id])
+        publish_change(self.__tablename__, 'update', self.version, self.id,
+                       self.format())
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        record_changed(self.__tablename__, [self.id])
+        record_changed(Casting.__tablename__)
+        publish_change(self.__tablename__, 'delete', self.version, self.id)
+
+    # Columns returned by format(), for queries that skip ORM instances
+    format_columns = ActorRow._fields
+    row_type = ActorRow
 
     def format(self):
         return {
@@ -98,3 +684,405 @@ class Actor(db.Model):
             'age': self.age,
             'gender': self.gender
         }
+
+
+'''
+Castings
+Link an actor to a movie, with the role they play
+'''
+
+
+class Casting(db.Model):
+    __tablename__ = "Castings"
+
+    movie_id = Column(Integer, ForeignKey('Movies.id', ondelete='CASCADE'),
+                      primary_key=True)
+    actor_id = Column(Integer, ForeignKey('Actors.id', ondelete='CASCADE'),
+                      primary_key=True, index=True)
+    role = Column(String)
+    movie = relationship('Movie', back_populates='cast')
+    actor = relationship('Actor', back_populates='roles')
+
+    def __init__(self, movie_id, actor_id, role):
+        self.movie_id = movie_id
+        self.actor_id = actor_id
+        self.role = role
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        record_changed(self.__tablename__)
+
+    def update(self):
+        db.session.commit()
+        record_changed(self.__tablename__)
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+        record_changed(self.__tablename__)
+
+    @staticmethod
+    def column_for(model):
+        return Casting.movie_id if model is Movie else Casting.actor_id
+
+    # Cast of a movie, needs the actor loaded
+    def format_actor(self):
+        return {
+            'actor': self.actor.format(),
+            'role': self.role
+        }
+
+    # Filmography of an actor, needs the movie loaded
+    def format_movie(self):
+        return {
+            'movie': self.movie.format(),
+            'role': self.role
+        }
+
+
+# The trigram indexes on title and name need the pg_trgm extension
+for table in (Movie.__table__, Actor.__table__):
+    event.listen(table, 'before_create', DDL(
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm'
+    ).execute_if(dialect='postgresql'))
+
+
+'''
+Change tracking
+Every write to Movies or Actors stamps the rows it changes with a new
+change version and the time (the version and updated_at columns), and
+records the ids it deletes as Tombstones with the same version. Changes
+after a version can then be found through the indexes on the version
+columns, at a cost that depends on the size of the change rather than
+the size of the tables.
+
+Versions come from the single row of ChangeCounters (created with the
+table, at version 0), incremented within the writing transaction. The
+row stays locked until the transaction commits, so versions are
+committed in order and a reader that sees version n has also seen every
+version before it. Writes to Movies and Actors are serialised as a
+result.
+
+next_change_version(connection)
+    increments the counter within the connection's transaction. Take it
+    before writing any rows, so writers always lock in the same order
+current_change_version(connection)
+    the latest committed version, 0 before the first write
+fetch_changes(model, since)
+    returns the rows changed after the given version (with their version
+    and updated_at), the ids deleted after it, and the version to pass
+    as since next time
+fetch_change_events(model, cursor)
+    returns the changes after an event cursor (see events.py) as change
+    events, in event id order, and the version they run up to
+'''
+
+
+class ChangeCounter(db.Model):
+    __tablename__ = "ChangeCounters"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+
+# The counter's single row, for databases created with db.create_all
+event.listen(ChangeCounter.__table__, 'after_create', DDL(
+    'INSERT INTO "ChangeCounters" (id, version) VALUES (1, 0)'
+))
+
+
+class Tombstone(db.Model):
+    __tablename__ = "Tombstones"
+    __table_args__ = (
+        Index('ix_tombstones_table_version', 'table_name', 'version'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    record_id = Column(Integer, nullable=False)
+    version = Column(BigInteger, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
+
+
+def next_change_version(connection):
+    table = ChangeCounter.__table__
+    increment = update(table).where(table.c.id == 1)\
+        .values(version=table.c.version + 1)
+    if supports_returning(connection):
+        return connection.execute(
+            increment.returning(table.c.version)).scalar_one()
+    if not connection.execute(increment).rowcount:
+        raise exc.InvalidRequestError(
+            'ChangeCounters has no row, run the database migrations')
+    return current_change_version(connection)
+
+
+def current_change_version(connection):
+    table = ChangeCounter.__table__
+    return connection.execute(
+        select(table.c.version).where(table.c.id == 1)).scalar() or 0
+
+
+def add_tombstones(connection, table_name, ids, version, deleted_at):
+    if ids:
+        connection.execute(insert(Tombstone.__table__), [
+            {'table_name': table_name, 'record_id': id,
+             'version': version, 'deleted_at': deleted_at}
+            for id in ids
+        ])
+
+
+def changed_rows(connection, model, since, version):
+    table = model.__table__
+    columns = [table.c[name] for name in model.format_columns]
+    stmt = select(*columns, table.c.version, table.c.updated_at)\
+        .where(table.c.version <= version)\
+        .order_by(table.c.version, table.c.id)
+    # Rows written before change tracking was added keep version 0, so a
+    # full sync has no lower bound
+    if since:
+        stmt = stmt.where(table.c.version > since)
+    return connection.execute(stmt).mappings().all()
+
+
+def deleted_rows(connection, model, since, version):
+    tombstones = Tombstone.__table__
+    stmt = select(tombstones.c.record_id, tombstones.c.version)\
+        .where(tombstones.c.table_name == model.__tablename__,
+               tombstones.c.version <= version)\
+        .order_by(tombstones.c.version, tombstones.c.record_id)
+    if since:
+        stmt = stmt.where(tombstones.c.version > since)
+    return connection.execute(stmt).all()
+
+
+def fetch_changes(model, since):
+    connection = db.session.connection()
+    # Read the counter first: every version up to it has been committed,
+    # and later versions are left for the next sync
+    version = current_change_version(connection)
+    rows = changed_rows(connection, model, since, version)
+    deleted = deleted_rows(connection, model, since, version)
+    return [dict(row) for row in rows], \
+        [row.record_id for row in deleted], version
+
+
+def fetch_change_events(model, cursor):
+    connection = db.session.connection()
+    version = current_change_version(connection)
+    table = model.__tablename__
+    make_row = model.row_type._make
+    # Include the cursor's own version when resuming part way through it
+    since, record_id = cursor
+    if record_id is not None:
+        since -= 1
+    # Only the latest state of each row is kept, so inserts are replayed
+    # as updates
+    events = [
+        change_event(table, 'update', row['version'], row['id'],
+                     make_row(row[name] for name in model.format_columns)
+                     .format())
+        for row in changed_rows(connection, model, since, version)
+    ] + [
+        change_event(table, 'delete', row.version, row.record_id)
+        for row in deleted_rows(connection, model, since, version)
+    ]
+    events = [event for event in events if after_cursor(event, cursor)]
+    events.sort(key=lambda event: (event['version'], event['record_id']))
+    return events, version
+
+
+# Stamp the rows written through the ORM (the model insert, update and
+# delete methods)
+@event.listens_for(RoutingSession, 'before_flush')
+def stamp_changes(session, flush_context, instances):
+    tracked = (Movie, Actor)
+    new = [obj for obj in session.new if isinstance(obj, tracked)]
+    modified = [obj for obj in session.dirty
+                if isinstance(obj, tracked) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, tracked)]
+    if not new and not modified and not deleted:
+        return
+
+    connection = session.connection()
+    version = next_change_version(connection)
+    now = datetime.datetime.utcnow()
+    deltas = Counter()
+    for obj in new + modified:
+        obj.version = version
+        obj.updated_at = now
+    for obj in new:
+        count_statistics(deltas, obj.__tablename__, current_values(obj), 1)
+    for obj in modified:
+        count_statistics(deltas, obj.__tablename__,
+                         previous_values(connection, obj), -1)
+        count_statistics(deltas, obj.__tablename__, current_values(obj), 1)
+    for obj in deleted:
+        count_statistics(deltas, obj.__tablename__,
+                         previous_values(connection, obj), -1)
+        # Not written, but kept on the object for its delete event
+        obj.version = version
+        add_tombstones(connection, obj.__tablename__, [obj.id], version, now)
+    apply_statistics(connection, deltas)
+
+
+def current_values(obj):
+    return {column: getattr(obj, column)
+            for _, column, _ in STATISTICS[obj.__tablename__]}
+
+
+def previous_values(connection, obj):
+    attrs = inspect(obj).attrs
+    values = {}
+    for _, column, _ in STATISTICS[obj.__tablename__]:
+        history = attrs[column].history
+        if history.deleted:
+            values[column] = history.deleted[0]
+        elif history.added:
+            # Set without being loaded first, so read the stored row
+            model = type(obj)
+            return connection.execute(
+                select(*statistic_columns(model))
+                .where(model.id == obj.id)).mappings().first()
+        else:
+            values[column] = getattr(obj, column)
+    return values
+
+
+'''
+Statistics
+Counts of actors by gender and age band and of movies by release year,
+kept as rows of the Statistics table (name, key, count) so GET /stats
+reads a few dozen rows instead of scanning Movies and Actors.
+
+Every write updates the counts within its own transaction, from the
+values of the rows it inserts, changes or deletes, so the cost of a
+write grows by a constant. Writes are already serialised by the change
+counter, taken before the counts are read, so two writes never race to
+create the same count.
+
+count_statistics(deltas, table, values, sign)
+    adds sign (1 or -1) to the counts a row's values fall under
+apply_statistics(connection, deltas)
+    applies the summed changes to the Statistics table
+refresh_statistics()
+    recounts every statistic from the tables, to repair counts after
+    writes made outside the app (see `python manage.py refresh_stats`)
+fetch_statistics()
+    returns every count, as {name: {key: count}}
+'''
+
+AGE_BANDS = (18, 30, 40, 50, 60)
+
+
+def age_band(age):
+    if age is None:
+        return 'unknown'
+    lower = 0
+    for upper in AGE_BANDS:
+        if age < upper:
+            return '{}-{}'.format(lower, upper - 1)
+        lower = upper
+    return '{}+'.format(lower)
+
+
+def release_year(release):
+    return str(release.year) if release is not None else 'unknown'
+
+
+def gender_key(gender):
+    return gender or 'unknown'
+
+
+# name, column and key function of each statistic, by table
+STATISTICS = {
+    Movie.__tablename__: (
+        ('movies_by_release_year', 'release', release_year),
+    ),
+    Actor.__tablename__: (
+        ('actors_by_gender', 'gender', gender_key),
+        ('actors_by_age', 'age', age_band),
+    )
+}
+
+
+class Statistic(db.Model):
+    __tablename__ = "Statistics"
+
+    name = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+
+def statistic_columns(model):
+    return [model.__table__.c[column]
+            for _, column, _ in STATISTICS[model.__tablename__]]
+
+
+def count_statistics(deltas, table, values, sign):
+    for name, column, key in STATISTICS[table]:
+        deltas[(name, key(values.get(column)))] += sign
+
+
+def apply_statistics(connection, deltas):
+    deltas = {stat: delta for stat, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    table = Statistic.__table__
+    existing = set(connection.execute(
+        select(table.c.name, table.c.key)
+        .where(tuple_(table.c.name, table.c.key).in_(list(deltas)))).all())
+
+    changes = [{'stat_name': name, 'stat_key': key, 'delta': delta}
+               for (name, key), delta in deltas.items()
+               if (name, key) in existing]
+    if changes:
+        connection.execute(
+            update(table)
+            .where(table.c.name == bindparam('stat_name'),
+                   table.c.key == bindparam('stat_key'))
+            .values(count=table.c.count + bindparam('delta')), changes)
+    created = [{'name': name, 'key': key, 'count': delta}
+               for (name, key), delta in deltas.items()
+               if (name, key) not in existing]
+    if created:
+        connection.execute(insert(table), created)
+
+
+def refresh_statistics():
+    try:
+        connection = db.session.connection()
+        # Holds the change counter, so no write runs during the recount
+        next_change_version(connection)
+        counts = Counter()
+        for model in (Movie, Actor):
+            for name, column, key in STATISTICS[model.__tablename__]:
+                column = model.__table__.c[column]
+                for value, count in connection.execute(
+                        select(column, func.count()).group_by(column)):
+                    counts[(name, key(value))] += count
+        connection.execute(delete(Statistic.__table__))
+        if counts:
+            connection.execute(insert(Statistic.__table__), [
+                {'name': name, 'key': key, 'count': count}
+                for (name, key), count in counts.items()
+            ])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    record_changed(Movie.__tablename__)
+    record_changed(Actor.__tablename__)
+
+
+def fetch_statistics():
+    table = Statistic.__table__
+    statistics = {name: {} for stats in STATISTICS.values()
+                  for name, _, _ in stats}
+    for name, key, count in db.session.connection().execute(
+            select(table.c.name, table.c.key, table.c.count)
+            .where(table.c.count != 0)
+            .order_by(table.c.name, table.c.key)):
+        statistics[name][key] = count
+    return statistics
@@ -0,0 +1,97 @@
+import datetime
+import decimal
+import json
+import os
+import uuid
+
+from flask import Response, current_app
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON providers
+Encode response bodies to bytes. Values are encoded as Flask's jsonify
+would: dates use the HTTP date format and keys are sorted when
+JSON_SORT_KEYS is set. StdlibJSONProvider also escapes non-ASCII
+characters when JSON_AS_ASCII is set (the default), giving the same
+bytes as jsonify. orjson always writes UTF-8, so with OrjsonProvider
+non-ASCII text is sent unescaped, which decodes to the same values.
+
+OrjsonProvider is used when orjson is installed, otherwise
+StdlibJSONProvider. Set JSON_PROVIDER to 'json' or 'orjson' to choose
+one explicitly.
+'''
+
+
+def default(o):
+    if isinstance(o, datetime.date):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            type(o).__name__))
+
+
+class StdlibJSONProvider:
+    name = 'json'
+
+    def __init__(self):
+        self.encoders = {
+            (sort_keys, ensure_ascii): json.JSONEncoder(
+                default=default, separators=(',', ':'),
+                sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+            for sort_keys in (False, True)
+            for ensure_ascii in (False, True)
+        }
+
+    def dumps(self, obj, sort_keys=False, ensure_ascii=True):
+        return self.encoders[sort_keys, ensure_ascii].encode(obj)\
+            .encode('utf-8')
+
+
+class OrjsonProvider:
+    name = 'orjson'
+
+    def __init__(self):
+        self.options = {
+            False: orjson.OPT_PASSTHROUGH_DATETIME,
+            True: orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS
+        }
+
+    def dumps(self, obj, sort_keys=False, ensure_ascii=True):
+        return orjson.dumps(obj, default=default,
+                            option=self.options[sort_keys])
+
+
+def get_json_provider():
+    provider = os.environ.get('JSON_PROVIDER', 'auto').lower()
+    if provider == 'orjson' or (provider == 'auto' and orjson is not None):
+        return OrjsonProvider()
+    return StdlibJSONProvider()
+
+
+json_provider = get_json_provider()
+
+
+'''
+dumps(obj)
+    encodes obj to bytes with the configured provider
+json_response(obj, status)
+    a faster equivalent of jsonify(obj), status
+'''
+
+
+def dumps(obj):
+    return json_provider.dumps(
+        obj, sort_keys=current_app.config['JSON_SORT_KEYS'],
+        ensure_ascii=current_app.config['JSON_AS_ASCII'])
+
+
+def json_response(obj, status=200):
+    return Response(dumps(obj) + b'\n', status=status,
+                    mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -1,10 +1,22 @@
 import os
+import re
+import gzip
+import time
+import shutil
+import tempfile
 import unittest
 import json
+import datetime
+from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import update
 
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import db, setup_db, Movie, Actor, Casting
+from admission import admission_store
+from serialization import StdlibJSONProvider, OrjsonProvider, orjson
+from auth import AuthError, JWKSKeyStore, TokenCache
+from benchmark import KEY_ID, setup_auth
 
 
 class AgencyTestCase(unittest.TestCase):
@@ -12,6 +24,8 @@ class AgencyTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
         self.client = self.app.test_client
+        # Every test uses the same token, so don't rate limit it
+        self.app.config['RATE_LIMIT_RATE'] = 0
         # Use Executive Producer token to enable all tests
         self.header = {
             "Authorization": "Bearer {}".format(os.environ['TOKEN'])
@@ -68,6 +82,172 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(data['total_movies'])
         self.assertTrue(len(data['movies']))
 
+    # Conditional request with an unchanged ETag
+    def test_304_get_movies_not_modified(self):
+        res = self.client().get('/movies', headers=self.header)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/movies',
+                                headers={**self.header,
+                                         'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+
+    # Conditional request after the movies have changed
+    def test_get_movies_modified(self):
+        res = self.client().get('/movies', headers=self.header)
+        etag = res.headers['ETag']
+
+        self.client().patch('/movies/1',
+                            json=self.update_movie,
+                            headers=self.header)
+        res = self.client().get('/movies',
+                                headers={**self.header,
+                                         'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # Repeated request served from the response cache
+    def test_get_movies_cached(self):
+        first = self.client().get('/movies', headers=self.header)
+        res = self.client().get('/metrics', headers=self.header)
+        hits = json.loads(res.data)['response_cache']['hits']
+
+        second = self.client().get('/movies', headers=self.header)
+        res = self.client().get('/metrics', headers=self.header)
+        metrics = json.loads(res.data)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(metrics['response_cache']['hits'], hits + 1)
+
+    # Request timings are reported
+    def test_get_movies_server_timing(self):
+        res = self.client().get('/movies', headers=self.header)
+        metrics = json.loads(self.client().get(
+            '/metrics', headers=self.header).data)
+
+        self.assertIn('auth;dur=', res.headers['Server-Timing'])
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+        self.assertTrue(metrics['requests']['GET /movies']['total']['count'])
+
+    # Small responses are not compressed
+    def test_get_movies_not_compressed(self):
+        res = self.client().get('/movies',
+                                headers={**self.header,
+                                         'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+    # Streamed responses are compressed
+    def test_export_actors_compressed(self):
+        res = self.client().get('/actors/export',
+                                headers={**self.header,
+                                         'Accept-Encoding': 'gzip'})
+        lines = gzip.decompress(res.data).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(len(lines))
+        self.assertTrue(json.loads(lines[0])['name'])
+
+    # Served by a read replica, here a second pool on the test database
+    def test_get_movies_replica(self):
+        os.environ['DB_REPLICA_URLS'] = self.database_path
+        os.environ['DB_REPLICA_LAG'] = '0'
+        try:
+            app = create_app()
+            setup_db(app, self.database_path)
+        finally:
+            del os.environ['DB_REPLICA_URLS']
+            del os.environ['DB_REPLICA_LAG']
+        client = app.test_client()
+
+        res = client.get('/movies', headers=self.header)
+        metrics = json.loads(client.get('/metrics', headers=self.header).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(
+            metrics['database_replicas']['replica_0']['checked_in'])
+
+    # Metrics need an Executive Producer token
+    def test_401_get_metrics_no_auth(self):
+        res = self.client().get('/metrics')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+
+    # Unless METRICS_PUBLIC is set
+    def test_get_metrics_public(self):
+        os.environ['METRICS_PUBLIC'] = 'true'
+        try:
+            app = create_app()
+            setup_db(app, self.database_path)
+        finally:
+            del os.environ['METRICS_PUBLIC']
+
+        res = app.test_client().get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['success'], True)
+
+    # Paginated with a cursor
+    def test_get_movies_paginated(self):
+        res = self.client().get('/movies?limit=1', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertTrue(data['total_movies'] > 1)
+        self.assertEqual(data['next_cursor'], data['movies'][0]['id'])
+
+        res = self.client().get(
+            '/movies?limit=1&after={}'.format(data['next_cursor']),
+            headers=self.header)
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(next_data['movies']), 1)
+        self.assertTrue(
+            next_data['movies'][0]['id'] > data['movies'][0]['id'])
+
+    # Invalid page size
+    def test_400_get_movies_invalid_limit(self):
+        res = self.client().get('/movies?limit=0', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    # Filtered by title and release date
+    def test_get_movies_filtered(self):
+        res = self.client().get(
+            '/movies?title=avengers&release_from=01/01/2015',
+            headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['total_movies'])
+        for movie in data['movies']:
+            self.assertIn('avengers', movie['title'].lower())
+
+    # Invalid release date filter
+    def test_400_get_movies_invalid_release_filter(self):
+        res = self.client().get('/movies?release_from=2015-01-01',
+                                headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     # No movies
     def test_404_get_movies(self):
         """
@@ -93,6 +273,47 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(data['total_actors'])
         self.assertTrue(len(data['actors']))
 
+    # Paginated with a cursor
+    def test_get_actors_paginated(self):
+        res = self.client().get('/actors?limit=1', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertTrue(data['total_actors'] > 1)
+        self.assertEqual(data['next_cursor'], data['actors'][0]['id'])
+
+        res = self.client().get(
+            '/actors?limit=1&after={}'.format(data['next_cursor']),
+            headers=self.header)
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(next_data['actors']), 1)
+        self.assertTrue(
+            next_data['actors'][0]['id'] > data['actors'][0]['id'])
+
+    # Invalid page size
+    def test_400_get_actors_invalid_limit(self):
+        res = self.client().get('/actors?limit=0', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    # Filtered by gender and age
+    def test_get_actors_filtered(self):
+        res = self.client().get('/actors?gender=F&age_min=30&age_max=40',
+                                headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['total_actors'])
+        for actor in data['actors']:
+            self.assertEqual(actor['gender'], 'F')
+            self.assertTrue(30 <= actor['age'] <= 40)
+
     # No actors
     def test_404_get_actors(self):
         """
@@ -107,6 +328,332 @@ class AgencyTestCase(unittest.TestCase):
     #     self.assertEqual(data['success'], False)
     #     self.assertEqual(data['message'], 'resource not found')
 
+    # Test /movies/<id> GET
+    # Successful operation
+    def test_get_movie(self):
+        res = self.client().get('/movies/1', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['movie']['id'], 1)
+
+    # Movie doesn't exist
+    def test_404_get_movie_does_not_exist(self):
+        res = self.client().get('/movies/10000', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    # Served from the record cache after an update
+    def test_get_movie_after_update(self):
+        self.client().get('/movies/1', headers=self.header)
+        self.client().patch('/movies/1',
+                            json=self.update_movie,
+                            headers=self.header)
+        res = self.client().get('/movies/1', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['title'], self.update_movie['title'])
+
+    # Several movies by id
+    def test_get_movies_by_ids(self):
+        res = self.client().get('/movies?ids=4,1,10000',
+                                headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [4, 1])
+        self.assertEqual(data['total_movies'], 2)
+
+    # Invalid ids
+    def test_400_get_movies_invalid_ids(self):
+        res = self.client().get('/movies?ids=1,a', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test /actors/<id> GET
+    # Successful operation
+    def test_get_actor(self):
+        res = self.client().get('/actors/1', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actor']['id'], 1)
+
+    # Actor doesn't exist
+    def test_404_get_actor_does_not_exist(self):
+        res = self.client().get('/actors/10000', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    # Test /movies/changes GET
+    # Only changes after the given version
+    def test_get_movie_changes(self):
+        res = self.client().get('/movies/changes', headers=self.header)
+        version = json.loads(res.data)['version']
+
+        res = self.client().post('/movies',
+                                 json=self.new_movie,
+                                 headers=self.header)
+        movie_id = json.loads(res.data)['created_movie']
+        self.client().patch('/movies/1',
+                            json=self.update_movie,
+                            headers=self.header)
+        self.client().delete('/movies/{}'.format(movie_id),
+                             headers=self.header)
+
+        res = self.client().get('/movies/changes?since={}'.format(version),
+                                headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1])
+        self.assertEqual(data['deleted'], [movie_id])
+        self.assertTrue(data['version'] > version)
+
+    # Rows from before change tracking are included in a full sync
+    def test_get_movie_changes_unversioned(self):
+        res = self.client().post('/movies',
+                                 json=self.new_movie,
+                                 headers=self.header)
+        movie_id = json.loads(res.data)['created_movie']
+        with self.app.app_context():
+            db.session.execute(update(Movie.__table__)
+                               .where(Movie.id == movie_id)
+                               .values(version=0))
+            db.session.commit()
+
+        res = self.client().get('/movies/changes', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(movie_id, [movie['id'] for movie in data['movies']])
+
+    # Invalid version
+    def test_400_get_movie_changes_invalid_since(self):
+        res = self.client().get('/movies/changes?since=latest',
+                                headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test /movies/events GET
+    # Live events
+    def test_movie_events(self):
+        res = self.client().get('/movies/events', headers=self.header,
+                                buffered=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+
+        self.client().patch('/movies/1',
+                            json=self.update_movie,
+                            headers=self.header)
+        stream = iter(res.response)
+        self.assertEqual(next(stream), b': connected\n\n')
+        event = next(stream).decode()
+        res.close()
+
+        self.assertIn('event: update\n', event)
+        self.assertIn('"record_id":1', event)
+
+    # Missed events replayed after the Last-Event-ID
+    def test_movie_events_resume(self):
+        res = self.client().get('/movies/changes', headers=self.header)
+        version = json.loads(res.data)['version']
+        self.client().patch('/movies/1',
+                            json=self.update_movie,
+                            headers=self.header)
+
+        res = self.client().get('/movies/events',
+                                headers={**self.header,
+                                         'Last-Event-ID': str(version)},
+                                buffered=False)
+        stream = iter(res.response)
+        next(stream)
+        event = next(stream).decode()
+        res.close()
+
+        self.assertTrue(event.startswith('id: {}.1\n'.format(version + 1)))
+        self.assertIn('"record_id":1', event)
+
+    # Resumed part way through a bulk write
+    def test_movie_events_resume_bulk(self):
+        res = self.client().get('/movies/changes', headers=self.header)
+        version = json.loads(res.data)['version']
+        res = self.client().post('/movies/bulk',
+                                 json=[self.new_movie] * 3,
+                                 headers=self.header)
+        ids = [row['id'] for row in json.loads(res.data)['results']]
+
+        res = self.client().get('/movies/events',
+                                headers={**self.header,
+                                         'Last-Event-ID': '{}.{}'.format(
+                                             version + 1, ids[0])},
+                                buffered=False)
+        stream = iter(res.response)
+        next(stream)
+        events = [next(stream).decode(), next(stream).decode()]
+        res.close()
+
+        for event, movie_id in zip(events, ids[1:]):
+            self.assertTrue(event.startswith(
+                'id: {}.{}\n'.format(version + 1, movie_id)))
+
+    # Over the token's rate limit
+    def test_429_get_movie_rate_limited(self):
+        self.app.config['RATE_LIMIT_RATE'] = 0.01
+        self.app.config['RATE_LIMIT_BURST'] = 1
+        try:
+            first = self.client().get('/movies/1', headers=self.header)
+            res = self.client().get('/movies/1', headers=self.header)
+        finally:
+            admission_store.clear()
+        data = json.loads(res.data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+    # Over the cap on requests in flight
+    def test_503_get_movie_overloaded(self):
+        self.app.config['CONCURRENCY_LIMITS']['read'] = 1
+        admission_store.acquire('read', 0)
+        try:
+            res = self.client().get('/movies/1', headers=self.header)
+        finally:
+            admission_store.release('read')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+    # Test /stats GET
+    # Counts kept up to date by writes
+    def test_get_stats(self):
+        res = self.client().get('/stats', headers=self.header)
+        before = json.loads(res.data)['actors']
+
+        self.client().post('/actors',
+                           json=self.new_actor,
+                           headers=self.header)
+        res = self.client().get('/stats', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actors']['total'], before['total'] + 1)
+        self.assertEqual(data['actors']['by_gender']['M'],
+                         before['by_gender'].get('M', 0) + 1)
+        self.assertEqual(data['actors']['by_age']['50-59'],
+                         before['by_age'].get('50-59', 0) + 1)
+        self.assertTrue(data['movies']['by_release_year'])
+
+    # Test /movies/<id>/cast POST, GET and DELETE
+    # Successful operation
+    def test_movie_cast(self):
+        res = self.client().post('/movies/1/cast',
+                                 json={'actor_id': 1, 'role': 'Iron Man'},
+                                 headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['cast']['actor']['id'], 1)
+        self.assertEqual(data['cast']['role'], 'Iron Man')
+
+        res = self.client().get('/movies/1/cast', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(1, [member['actor']['id'] for member in data['cast']])
+
+        res = self.client().get('/actors/1/movies', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(1, [role['movie']['id'] for role in data['movies']])
+
+        res = self.client().delete('/movies/1/cast/1', headers=self.header)
+        casting = Casting.query.filter(Casting.movie_id == 1,
+                                       Casting.actor_id == 1).one_or_none()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(casting, None)
+
+    # Body that isn't an object, or a role that isn't a string
+    def test_400_add_movie_cast_bad_body(self):
+        for body in ([1], 'x', {'actor_id': 1, 'role': 1}):
+            res = self.client().post('/movies/1/cast', json=body,
+                                     headers=self.header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bad request')
+
+    # Movie doesn't exist
+    def test_404_get_movie_cast_does_not_exist(self):
+        res = self.client().get('/movies/10000/cast', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    # List with the cast of each movie
+    def test_get_movies_expand_cast(self):
+        res = self.client().get('/movies?expand=cast', headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for movie in data['movies']:
+            self.assertIn('cast', movie)
+
+    # Test /movies/export GET
+    # Successful operation
+    def test_export_movies(self):
+        res = self.client().get('/movies/export', headers=self.header)
+        movies = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(movies))
+        self.assertTrue(movies[0]['id'])
+
+    # Test /actors/export GET
+    # Successful operation, as a JSON array
+    def test_export_actors_json(self):
+        res = self.client().get('/actors/export?format=json',
+                                headers=self.header)
+        actors = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertTrue(len(actors))
+        self.assertTrue(actors[0]['id'])
+
+    # Unsupported format
+    def test_400_export_actors_invalid_format(self):
+        res = self.client().get('/actors/export?format=xml',
+                                headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     # Test /movies DELETE
     # Successful operation
     def test_delete_movie(self):
@@ -118,9 +665,42 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted_id'], 2)
+        self.assertEqual(data['movie']['id'], 2)
+        self.assertNotIn('movies', data)
+        self.assertEqual(movie, None)
+
+    # Successful operation, returning the full list
+    def test_delete_movie_full_response(self):
+        res = self.client().delete('/movies/3?response=full',
+                                   headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted_id'], 3)
         self.assertTrue(data['total_movies'])
         self.assertTrue(len(data['movies']))
-        self.assertEqual(movie, None)
+
+    # Successful operation, removing the movie's cast
+    def test_delete_movie_with_cast(self):
+        res = self.client().post('/movies',
+                                 json=self.new_movie,
+                                 headers=self.header)
+        movie_id = json.loads(res.data)['created_movie']
+        self.client().post('/movies/{}/cast'.format(movie_id),
+                           json={'actor_id': 1, 'role': 'Lead'},
+                           headers=self.header)
+
+        res = self.client().delete('/movies/{}'.format(movie_id),
+                                   headers=self.header)
+        data = json.loads(res.data)
+
+        casting = Casting.query.filter(Casting.movie_id == movie_id)\
+            .one_or_none()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted_id'], movie_id)
+        self.assertEqual(casting, None)
 
     # Movie doesn't exist
     def test_404_delete_movie_does_not_exist(self):
@@ -142,9 +722,21 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted_id'], 2)
+        self.assertEqual(data['actor']['id'], 2)
+        self.assertNotIn('actors', data)
+        self.assertEqual(actor, None)
+
+    # Successful operation, returning the full list
+    def test_delete_actor_full_response(self):
+        res = self.client().delete('/actors/3?response=full',
+                                   headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted_id'], 3)
         self.assertTrue(data['total_actors'])
         self.assertTrue(len(data['actors']))
-        self.assertEqual(actor, None)
 
     # Actor doesn't exist
     def test_404_delete_actor_does_not_exist(self):
@@ -163,6 +755,20 @@ class AgencyTestCase(unittest.TestCase):
                                  headers=self.header)
         data = json.loads(res.data)
 
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['created_movie'])
+        self.assertEqual(data['movie']['id'], data['created_movie'])
+        self.assertNotIn('movies', data)
+
+    # Successful operation, returning the full list
+    def test_create_movie_full_response(self):
+        res = self.client().post('/movies',
+                                 json=self.new_movie,
+                                 headers={**self.header,
+                                          'X-Response-Mode': 'full'})
+        data = json.loads(res.data)
+
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['created_movie'])
@@ -186,6 +792,20 @@ class AgencyTestCase(unittest.TestCase):
                                  headers=self.header)
         data = json.loads(res.data)
 
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['created_actor'])
+        self.assertEqual(data['actor']['id'], data['created_actor'])
+        self.assertNotIn('actors', data)
+
+    # Successful operation, returning the full list
+    def test_create_actor_full_response(self):
+        res = self.client().post('/actors',
+                                 json=self.new_actor,
+                                 headers={**self.header,
+                                          'X-Response-Mode': 'full'})
+        data = json.loads(res.data)
+
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['created_actor'])
@@ -201,6 +821,78 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    # Test /movies/bulk POST
+    # Successful operation, with one invalid row
+    def test_bulk_create_movies(self):
+        res = self.client().post('/movies/bulk',
+                                 json={'movies': [
+                                     self.new_movie,
+                                     {'title': 'Iron Man',
+                                      'release': '2008-05-02'}
+                                 ]},
+                                 headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_succeeded'], 1)
+        self.assertEqual(data['total_failed'], 1)
+        self.assertTrue(data['results'][0]['id'])
+        self.assertEqual(data['results'][1]['success'], False)
+
+    # Rows are inserted with one statement, not one per row
+    def test_bulk_create_movies_queries(self):
+        queries = []
+        for count in (1, 20):
+            res = self.client().post('/movies/bulk',
+                                     json=[self.new_movie] * count,
+                                     headers=self.header)
+            queries.append(re.search(r'desc="(\d+) queries"',
+                                     res.headers['Server-Timing']).group(1))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['total_succeeded'], 20)
+        self.assertEqual(queries[0], queries[1])
+
+    # Create without any rows
+    def test_400_bulk_create_movies_no_data(self):
+        res = self.client().post('/movies/bulk',
+                                 json={'movies': []},
+                                 headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    # Test /actors/bulk PATCH
+    # Successful operation, with one actor that doesn't exist
+    def test_bulk_update_actors(self):
+        res = self.client().patch('/actors/bulk',
+                                  json={'actors': [
+                                      {'id': 1, **self.update_actor},
+                                      {'id': 10000, **self.update_actor}
+                                  ]},
+                                  headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_succeeded'], 1)
+        self.assertEqual(data['results'][0]['id'], 1)
+        self.assertEqual(data['results'][1]['error'], 'resource not found')
+
+    # Test /actors/bulk DELETE
+    # Actors don't exist
+    def test_bulk_delete_actors_do_not_exist(self):
+        res = self.client().delete('/actors/bulk',
+                                   json={'ids': [10000, 10001]},
+                                   headers=self.header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_succeeded'], 0)
+        self.assertEqual(data['total_failed'], 2)
+
     # Test /movies PATCH
     # Successful operation
     def test_patch_movie(self):
@@ -266,6 +958,179 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'resource not found')
 
 
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # setup_auth also points the auth settings at the local key set,
+        # so put the environment back afterwards
+        environ = dict(os.environ)
+        cls.directory = tempfile.mkdtemp()
+        setup_auth(cls.directory)
+        os.environ.clear()
+        os.environ.update(environ)
+        cls.jwks_path = os.path.join(cls.directory, 'jwks.json')
+        with open(cls.jwks_path) as f:
+            cls.jwks = json.load(f)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        with open(self.jwks_path, 'w') as f:
+            json.dump(self.jwks, f)
+        self.store = JWKSKeyStore(url='file://' + self.jwks_path, ttl=60,
+                                  min_refresh_interval=30)
+
+    # Replace the key set with one whose key has the given kid
+    def rotate_keys(self, kid):
+        jwks = {'keys': [dict(key, kid=kid) for key in self.jwks['keys']]}
+        with open(self.jwks_path, 'w') as f:
+            json.dump(jwks, f)
+
+    # Move the store's clock back, as if seconds had passed
+    def age(self, seconds):
+        self.store.loaded_at -= seconds
+        self.store.last_attempt -= seconds
+
+    # Test the first load
+    def test_get_key(self):
+        key = self.store.get_key(KEY_ID)
+
+        self.assertEqual(key['kid'], KEY_ID)
+        self.assertIsNotNone(self.store.loaded_at)
+
+    def test_get_key_unknown(self):
+        self.store.get_key(KEY_ID)
+        self.store.last_attempt -= 30
+
+        self.assertIsNone(self.store.get_key('unknown'))
+
+    # Unknown kids refetch no more than once per min_refresh_interval
+    def test_get_key_unknown_rate_limited(self):
+        self.store.get_key(KEY_ID)
+        self.rotate_keys('rotated')
+
+        self.assertIsNone(self.store.get_key('rotated'))
+
+        self.store.last_attempt -= 30
+        key = self.store.get_key('rotated')
+
+        self.assertEqual(key['kid'], 'rotated')
+
+    # Keys past their TTL are served while they refresh in the background
+    def test_get_key_ttl_refresh(self):
+        self.store.get_key(KEY_ID)
+        self.rotate_keys('rotated')
+        self.age(60)
+        key = self.store.get_key(KEY_ID)
+
+        self.assertEqual(key['kid'], KEY_ID)
+
+        deadline = time.monotonic() + 5
+        while 'rotated' not in self.store.keys \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(list(self.store.keys), ['rotated'])
+
+    # Stale keys are kept when a refresh fails
+    def test_get_key_failed_refresh(self):
+        self.store.get_key(KEY_ID)
+        os.remove(self.jwks_path)
+        self.age(60)
+        self.store.refresh()
+        key = self.store.get_key(KEY_ID)
+
+        self.assertEqual(key['kid'], KEY_ID)
+
+    def test_503_get_key_failed_load(self):
+        os.remove(self.jwks_path)
+
+        with self.assertRaises(AuthError) as context:
+            self.store.get_key(KEY_ID)
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {'sub': 'user', 'exp': time.time() + 3600}
+
+    # Test hit and miss counting
+    def test_get(self):
+        self.assertIsNone(self.cache.get('token'))
+
+        self.cache.set('token', self.payload)
+
+        self.assertEqual(self.cache.get('token'), self.payload)
+        self.assertEqual(self.cache.stats(), {
+            'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1})
+
+    # Entries are not served once the token's exp is reached
+    def test_get_expired(self):
+        self.cache.set('token', dict(self.payload, exp=time.time()))
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # The least recently used entry is evicted
+    def test_set_evicts_least_recently_used(self):
+        self.cache.set('first', self.payload)
+        self.cache.set('second', self.payload)
+        self.cache.get('first')
+        self.cache.set('third', self.payload)
+
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.assertIsNone(self.cache.get('second'))
+        self.assertEqual(self.cache.get('first'), self.payload)
+        self.assertEqual(self.cache.get('third'), self.payload)
+
+    # Tokens without an exp claim are not cached
+    def test_set_without_exp(self):
+        self.cache.set('token', {'sub': 'user'})
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+
+class JSONProviderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.value = {'title': 'Amélie', 'release': datetime.date(2001, 4, 25),
+                      'id': 1}
+
+    def jsonify(self):
+        with self.app.app_context():
+            return jsonify(self.value).data
+
+    # Same bytes as jsonify, escaping non-ASCII while JSON_AS_ASCII is set
+    def test_stdlib_provider(self):
+        provider = StdlibJSONProvider()
+        for ensure_ascii in (True, False):
+            self.app.config['JSON_AS_ASCII'] = ensure_ascii
+            data = provider.dumps(self.value, sort_keys=True,
+                                  ensure_ascii=ensure_ascii)
+
+            self.assertEqual(data + b'\n', self.jsonify())
+
+    # orjson always writes UTF-8, which decodes to the same values
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_provider(self):
+        provider = OrjsonProvider()
+        data = provider.dumps(self.value, sort_keys=True)
+
+        self.assertEqual(json.loads(data), json.loads(self.jsonify()))
+
+        self.app.config['JSON_AS_ASCII'] = False
+
+        self.assertEqual(data + b'\n', self.jsonify())
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,130 @@
+import fcntl
+import logging
+import os
+import random
+import time
+from threading import Lock
+
+'''
+Table versions
+A counter per table that is bumped whenever the table is written to.
+The version is used to build ETags, so conditional requests can be
+answered without querying the database.
+
+Counters start from a random value, so a version store that has been
+reset (e.g. after a restart) does not reissue previously seen versions.
+
+changed_at(table) returns the time of the table's last bump, or None if
+it hasn't been written to since the store was created.
+'''
+
+
+def initial_version():
+    return random.getrandbits(48)
+
+
+'''
+LocalVersionStore
+Keeps the counters in memory. Only suitable when a single process
+serves the application.
+'''
+
+
+class LocalVersionStore:
+    def __init__(self):
+        self.versions = {}
+        self.changed = {}
+        self.lock = Lock()
+
+    def get(self, table):
+        version = self.versions.get(table)
+        if version is None:
+            with self.lock:
+                version = self.versions.setdefault(table, initial_version())
+        return version
+
+    def bump(self, table):
+        with self.lock:
+            version = self.versions.get(table, initial_version()) + 1
+            self.versions[table] = version
+            self.changed[table] = time.time()
+            return version
+
+    def changed_at(self, table):
+        return self.changed.get(table)
+
+
+'''
+FileVersionStore
+Keeps one counter file per table in a directory, so all worker processes
+on a host see the same versions. Writes are serialised with a file lock
+and replace the counter file atomically, so reads need no lock.
+'''
+
+
+class FileVersionStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, table):
+        return os.path.join(self.directory, f'{table}.version')
+
+    def get(self, table):
+        try:
+            with open(self.path(table)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return self.bump(table)
+
+    def bump(self, table):
+        # Writers take a separate lock file, as the counter file itself is
+        # replaced on every bump
+        fd = os.open(self.path(table) + '.lock',
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path(table)) as f:
+                    version = int(f.read()) + 1
+            except (FileNotFoundError, ValueError):
+                version = initial_version()
+            # Readers don't lock, so write a new file and swap it in, so
+            # they never see a partly written counter
+            temp_path = '{}.{}.tmp'.format(self.path(table), os.getpid())
+            with open(temp_path, 'w') as f:
+                f.write(str(version))
+            os.replace(temp_path, self.path(table))
+            return version
+
+    def changed_at(self, table):
+        try:
+            return os.stat(self.path(table)).st_mtime
+        except FileNotFoundError:
+            return None
+
+
+'''
+get_version_store()
+    uses a FileVersionStore when VERSION_STORE_DIR is set, otherwise
+    keeps versions in memory. gunicorn.conf.py sets VERSION_STORE_DIR
+    when it starts more than one worker; with any other server running
+    several processes, a warning is logged, as each process would keep
+    serving its own cached responses, records and ETags after another
+    process writes
+'''
+
+
+def get_version_store():
+    directory = os.environ.get('VERSION_STORE_DIR', None)
+    if directory:
+        return FileVersionStore(directory)
+    if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+        logging.getLogger(__name__).warning(
+            'WEB_CONCURRENCY is above 1 but VERSION_STORE_DIR is not set: '
+            'table versions are kept per process, so other workers will '
+            'serve stale cached responses after a write')
+    return LocalVersionStore()
+
+
+version_store = get_version_store()